@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares the opacity reduction and compositing of ``watermarker.utils``
+with the implementation they replaced (``ImageEnhance.Brightness`` on the
+split alpha band, and compositing through an RGBA copy of the image), using
+large, high-opacity tiled watermarks.
+
+    python benchmarks/bench_blend.py
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "watermarker.tests.settings")
+
+from PIL import Image, ImageEnhance  # noqa: E402
+
+from watermarker.utils import reduce_opacity, tile_mark, watermark  # noqa: E402
+
+IMAGE_SIZES = [(1920, 1080), (6000, 4000)]
+MARK_SIZES = [(400, 200), (1600, 800)]
+OPACITY = 0.8
+
+
+def old_reduce_opacity(img, opacity):
+    img = img.copy()
+    alpha = img.split()[3]
+    alpha = ImageEnhance.Brightness(alpha).enhance(opacity)
+    img.putalpha(alpha)
+    return img
+
+
+def old_tiled(img, mark):
+    mark = old_reduce_opacity(mark, OPACITY)
+    layer = tile_mark(mark, img.size)
+    return Image.composite(layer, img.convert("RGBA"), layer).convert("RGB")
+
+
+def new_tiled(img, mark):
+    return watermark(img, mark, opacity=OPACITY, tile=True, noalpha=True)
+
+
+def best_of(func, repeat=3):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    print("%-12s %-12s %-16s %10s %10s %8s" % ("mark", "image", "operation", "old ms", "new ms", "speedup"))
+    for mark_size in MARK_SIZES:
+        mark = Image.effect_noise(mark_size, 64).convert("RGB")
+        mark.putalpha(Image.effect_noise(mark_size, 128))
+
+        old = best_of(lambda: old_reduce_opacity(mark, OPACITY))
+        new = best_of(lambda: reduce_opacity(mark, OPACITY))
+        print(
+            "%-12s %-12s %-16s %10.1f %10.1f %7.1fx"
+            % ("%ix%i" % mark_size, "-", "opacity", old * 1000, new * 1000, old / new)
+        )
+
+        for size in IMAGE_SIZES:
+            img = Image.effect_noise(size, 64).convert("RGB")
+            assert old_tiled(img, mark).tobytes() == new_tiled(img, mark).tobytes()
+
+            old = best_of(lambda: old_tiled(img, mark))
+            new = best_of(lambda: new_tiled(img, mark))
+            print(
+                "%-12s %-12s %-16s %10.1f %10.1f %7.1fx"
+                % ("%ix%i" % mark_size, "%ix%i" % size, "tiled, noalpha", old * 1000, new * 1000, old / new)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares decoding a large JPEG at full size and scaling it down afterwards
+with ``watermarker.utils.downscale``, which decodes it at a reduced scale.
+
+    python benchmarks/bench_downscale.py
+
+"""
+import os
+import sys
+import timeit
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "watermarker.tests.settings")
+
+from PIL import Image  # noqa: E402
+
+from watermarker.utils import determine_size, downscale  # noqa: E402
+
+SOURCE_SIZES = [(3000, 2000), (6000, 4000)]
+MAX_SIZES = ["1200", "600"]
+
+
+def make_jpeg(size):
+    buf = BytesIO()
+    Image.linear_gradient("L").resize(size).convert("RGB").save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+def full_decode(data, size):
+    im = Image.open(BytesIO(data))
+    im.load()
+    return im.resize(size, resample=Image.LANCZOS)
+
+
+def reduced_decode(data, size):
+    return downscale(Image.open(BytesIO(data)), size)
+
+
+def best_of(func, repeat=3):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    print("%-12s %-9s %-10s %10s %10s %8s" % ("source", "max_size", "output", "full ms", "draft ms", "speedup"))
+    for source_size in SOURCE_SIZES:
+        data = make_jpeg(source_size)
+        for max_size in MAX_SIZES:
+            size = determine_size(max_size, source_size)
+            full = best_of(lambda: full_decode(data, size))
+            reduced = best_of(lambda: reduced_decode(data, size))
+            print(
+                "%-12s %-9s %-10s %10.1f %10.1f %7.1fx"
+                % ("%ix%i" % source_size, max_size, "%ix%i" % size, full * 1000, reduced * 1000, full / reduced)
+            )
+
+
+if __name__ == "__main__":
+    main()
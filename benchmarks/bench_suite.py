@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Measures the hot paths of django-watermark on synthetic images from 0.3 to
+50 megapixels, and writes the results to a JSON file that later runs can be
+compared with:
+
+* ``utils.watermark`` with small and large, tiled and single, rotated and
+  opaque watermarks
+* ``Watermarker.__call__`` creating an image in several output formats
+  (cold), and finding it in the cache (warm)
+* ``Watermarker.batch`` against the same images watermarked one by one
+* setting Django up and importing the template tags in a fresh interpreter,
+  with and without ``WATERMARK_PRELOAD``
+
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --quick --compare benchmarks/results/baseline.json
+
+A full run takes a few minutes.  With ``--compare``, cases that got more
+than ``--threshold`` slower than in the baseline are reported, and the exit
+status is 1 if there are any.
+
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "watermarker.tests.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import PIL  # noqa: E402
+from django.core.files.base import ContentFile  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.test.utils import override_settings  # noqa: E402
+from PIL import Image, ImageDraw  # noqa: E402
+
+from watermarker import cache  # noqa: E402
+from watermarker.models import Watermark, WatermarkedImage  # noqa: E402
+from watermarker.storage import get_manifest  # noqa: E402
+from watermarker.templatetags.watermark import Watermarker  # noqa: E402
+from watermarker.utils import watermark  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+MEGAPIXELS = [0.3, 2, 12, 50]
+QUICK_MEGAPIXELS = [0.3, 2]
+MARK_SIZES = {"small": (256, 128), "large": (1024, 512)}
+FORMATS = ["jpeg", "png", "webp"]
+BATCH_IMAGES = 16
+BATCH_MEGAPIXELS = 2
+WARM_CALLS = 1000
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# prints how long setting Django up and then importing the template tags took
+IMPORT_SCRIPT = """
+import os, sys, time
+sys.path.insert(0, %(root)r)
+os.environ["DJANGO_SETTINGS_MODULE"] = "watermarker.tests.settings"
+start = time.perf_counter()
+import django
+from django.conf import settings
+settings.WATERMARK_PRELOAD = %(preload)r
+django.setup()
+setup = time.perf_counter()
+import watermarker.templatetags.watermark
+print(setup - start, time.perf_counter() - setup)
+"""
+
+
+def image_size(megapixels):
+    """Returns the 3:2 size of an image of `megapixels`"""
+    width = int(round((megapixels * 1e6 * 1.5) ** 0.5))
+    return width, int(round(width / 1.5))
+
+
+def make_image(size):
+    """Makes a photo-like RGB image, with gradients and noise"""
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 48).point(lambda v: v // 2 + 64)
+    return Image.merge("RGB", [gradient, noise, gradient.transpose(Image.ROTATE_180)])
+
+
+def make_mark(size):
+    """Makes a watermark with soft, partially transparent shapes"""
+    mark = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(mark)
+    draw.ellipse((0, 0, size[0] - 1, size[1] - 1), fill=(255, 255, 255, 160))
+    draw.rectangle((size[0] // 4, size[1] // 4, size[0] * 3 // 4, size[1] * 3 // 4), fill=(20, 20, 20, 220))
+    return mark
+
+
+def measure(func, repeat, setup=None, number=1):
+    times = timeit.repeat(func, setup=setup or (lambda: None), number=number, repeat=repeat)
+    return summarize([t / number for t in times])
+
+
+def summarize(times):
+    return {"times": times, "min": min(times), "median": statistics.median(times)}
+
+
+class Suite(object):
+    def __init__(self, megapixels, repeat, media_root):
+        self.megapixels = megapixels
+        self.repeat = repeat
+        self.media_root = media_root
+        self.results = []
+
+    def record(self, group, name, params, result):
+        entry = dict(result, group=group, name="%s/%s" % (group, name), params=params)
+        self.results.append(entry)
+        print("%-60s %10.2f %10.2f" % (entry["name"], entry["min"] * 1000, entry["median"] * 1000))
+
+    def run(self):
+        print("%-60s %10s %10s" % ("case", "min ms", "median ms"))
+        self.bench_import()
+        marks = {name: make_mark(size) for name, size in MARK_SIZES.items()}
+        self.watermark_object = self.create_watermark(marks["small"])
+
+        for megapixels in self.megapixels:
+            size = image_size(megapixels)
+            img = make_image(size)
+            self.bench_watermark(megapixels, img, marks)
+
+            url = self.save_source("source-%g.jpg" % megapixels, img)
+            del img
+            self.bench_call(megapixels, url)
+
+        self.bench_batch()
+        return self.results
+
+    def bench_import(self):
+        for preload in (False, True):
+            setup_times, import_times = [], []
+            for i in range(max(self.repeat, 5)):
+                script = IMPORT_SCRIPT % {"root": ROOT_DIR, "preload": preload}
+                output = subprocess.run(
+                    [sys.executable, "-c", script], stdout=subprocess.PIPE, check=True, universal_newlines=True
+                )
+                setup_time, import_time = [float(value) for value in output.stdout.split()]
+                setup_times.append(setup_time)
+                import_times.append(import_time)
+            params = {"preload": preload}
+            self.record("import", "setup/preload=%i" % preload, params, summarize(setup_times))
+            self.record("import", "templatetags/preload=%i" % preload, params, summarize(import_times))
+
+    def bench_watermark(self, megapixels, img, marks):
+        cases = []
+        for mark_name in MARK_SIZES:
+            for tile in (False, True):
+                cases.append({"mark": mark_name, "tile": tile, "rotation": 0, "opacity": 0.5})
+        cases.append({"mark": "small", "tile": True, "rotation": 30, "opacity": 0.5})
+        cases.append({"mark": "large", "tile": False, "rotation": 30, "opacity": 0.5})
+        cases.append({"mark": "small", "tile": True, "rotation": 0, "opacity": 1.0})
+
+        for case in cases:
+            mark = marks[case["mark"]]
+            kwargs = {key: value for key, value in case.items() if key != "mark"}
+            result = measure(lambda: watermark(img, mark, position="C", noalpha=True, **kwargs), self.repeat)
+            name = "%gMP/mark=%s/tile=%i/rotation=%i/opacity=%s" % (
+                megapixels,
+                case["mark"],
+                case["tile"],
+                case["rotation"],
+                case["opacity"],
+            )
+            self.record("watermark", name, dict(case, megapixels=megapixels), result)
+
+    def bench_call(self, megapixels, url):
+        watermarker = Watermarker()
+
+        for format in FORMATS:
+            args = {"position": "BR", "opacity": 0.5, "format": format}
+            name = "%gMP/format=%s" % (megapixels, format)
+            params = dict(args, megapixels=megapixels)
+
+            result = measure(lambda: watermarker(url, "bench", **args), self.repeat, setup=self.reset)
+            self.record("call_cold", name, params, result)
+
+            watermarker(url, "bench", **args)
+            result = measure(lambda: watermarker(url, "bench", **args), self.repeat, number=WARM_CALLS)
+            self.record("call_warm", name, params, result)
+
+    def bench_batch(self):
+        img = make_image(image_size(BATCH_MEGAPIXELS))
+        urls = [self.save_source("batch-%i.jpg" % i, img) for i in range(BATCH_IMAGES)]
+        del img
+
+        args = "bench,position=BR,opacity=50"
+        watermarker = Watermarker()
+        params = {"images": BATCH_IMAGES, "megapixels": BATCH_MEGAPIXELS}
+
+        serial = lambda: [watermarker(url, "bench", position="BR", opacity=0.5) for url in urls]  # noqa: E731
+        result = measure(serial, self.repeat, setup=self.reset)
+        self.record("batch", "serial", params, result)
+        result = measure(lambda: watermarker.batch([(url, args) for url in urls]), self.repeat, setup=self.reset)
+        self.record("batch", "concurrent", params, result)
+
+    def create_watermark(self, mark):
+        buf = BytesIO()
+        mark.save(buf, "PNG")
+        watermark_object = Watermark(name="bench")
+        watermark_object.image.save("bench.png", ContentFile(buf.getvalue()))
+        return watermark_object
+
+    def save_source(self, name, img):
+        img.save(os.path.join(self.media_root, name), "JPEG", quality=90)
+        return "/media/" + name
+
+    def reset(self):
+        """Forgets about all watermarked images, so they have to be created again"""
+        shutil.rmtree(os.path.join(self.media_root, "watermarked"), ignore_errors=True)
+        WatermarkedImage.objects.all().delete()
+        cache.invalidate()
+        get_manifest().clear()
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = {entry["name"]: entry for entry in json.load(f)["results"]}
+
+    print()
+    print("%-60s %10s %10s %8s" % ("case", "base ms", "new ms", "ratio"))
+    regressions = 0
+    for entry in results:
+        base = baseline.get(entry["name"])
+        if base is None:
+            continue
+        ratio = entry["median"] / base["median"]
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions += 1
+            flag = "  SLOWER"
+        print(
+            "%-60s %10.2f %10.2f %7.2fx%s"
+            % (entry["name"], base["median"] * 1000, entry["median"] * 1000, ratio, flag)
+        )
+    print("%i regressions" % regressions)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--megapixels", help="Comma separated sizes of the source images, in megapixels")
+    parser.add_argument("--quick", action="store_true", help="Only use small images and measure each case once")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of times to measure each case")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Slowdown that counts as a regression")
+    options = parser.parse_args()
+
+    if options.megapixels:
+        megapixels = [float(value) for value in options.megapixels.split(",")]
+    else:
+        megapixels = QUICK_MEGAPIXELS if options.quick else MEGAPIXELS
+    repeat = 1 if options.quick else options.repeat
+
+    media_root = tempfile.mkdtemp()
+    try:
+        with override_settings(
+            MEDIA_ROOT=media_root, MEDIA_URL="/media/", WATERMARK_LOCK_DIR=os.path.join(media_root, "locks")
+        ):
+            call_command("migrate", run_syncdb=True, verbosity=0)
+            results = Suite(megapixels, repeat, media_root).run()
+    finally:
+        shutil.rmtree(media_root)
+
+    output = options.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, time.strftime("%Y%m%d-%H%M%S.json"))
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "python": platform.python_version(),
+                "pillow": PIL.__version__,
+                "django": django.get_version(),
+                "platform": platform.platform(),
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "repeat": repeat,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print("Results written to %s" % output)
+
+    if options.compare and compare(results, options.compare, options.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
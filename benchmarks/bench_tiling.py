@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compares ``watermarker.utils.tile_mark`` with the per-tile paste loop it
+replaced, for a range of watermark and image sizes.
+
+    python benchmarks/bench_tiling.py
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "watermarker.tests.settings")
+
+from PIL import Image  # noqa: E402
+
+from watermarker.utils import tile_mark  # noqa: E402
+
+MARK_SIZES = [(16, 16), (64, 48), (200, 100)]
+IMAGE_SIZES = [(640, 480), (1920, 1080), (6000, 4000)]
+
+
+def paste_loop(mark, size, offset):
+    layer = Image.new("RGBA", size, (0, 0, 0, 0))
+    for y in range(offset[1], size[1], mark.size[1]):
+        for x in range(offset[0], size[0], mark.size[0]):
+            layer.paste(mark, (x, y))
+    return layer
+
+
+def best_of(func, repeat=3):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    print("%-12s %-12s %8s %10s %10s %8s" % ("mark", "image", "tiles", "loop ms", "tiled ms", "speedup"))
+    for mark_size in MARK_SIZES:
+        mark = Image.effect_noise(mark_size, 64).convert("RGBA")
+        for size in IMAGE_SIZES:
+            offset = (-mark_size[0] // 3, -mark_size[1] // 3)
+            assert paste_loop(mark, size, offset).tobytes() == tile_mark(mark, size, offset).tobytes()
+
+            tiles = (-(-(size[0] - offset[0]) // mark_size[0])) * (-(-(size[1] - offset[1]) // mark_size[1]))
+            loop = best_of(lambda: paste_loop(mark, size, offset))
+            tiled = best_of(lambda: tile_mark(mark, size, offset))
+            print(
+                "%-12s %-12s %8i %10.1f %10.1f %7.1fx"
+                % ("%ix%i" % mark_size, "%ix%i" % size, tiles, loop * 1000, tiled * 1000, loop / tiled)
+            )
+
+
+if __name__ == "__main__":
+    main()
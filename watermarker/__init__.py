@@ -0,0 +1,5 @@
+import django
+
+if django.VERSION < (3, 2):
+    # later versions find the app config themselves
+    default_app_config = "watermarker.apps.WatermarkerConfig"
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Watermarking from async views.
+
+The watermark is looked up with Django's async ORM.  Everything that touches
+files or renders images runs on a pool of ``WATERMARK_ASYNC_WORKERS``
+threads, so the event loop is never blocked.
+
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+from django.db import connections
+from django.utils.encoding import smart_str
+
+from .conf import settings
+from .spec import WatermarkSpec
+from .templatetags.watermark import Watermarker
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.WATERMARK_ASYNC_WORKERS, thread_name_prefix="watermarker-async"
+            )
+        return _executor
+
+
+def _call(watermarker, url, spec):
+    try:
+        return watermarker(url, spec)
+    finally:
+        # don't leak the connections of the pool's threads
+        connections.close_all()
+
+
+async def awatermark(url, args=""):
+    """
+    Returns the URL to a watermarked copy of the image specified, just like
+    the ``watermark`` filter does with the same arguments
+    """
+    spec = WatermarkSpec.parse(args)
+    watermarker = Watermarker()
+    await watermarker.aget_watermark(spec.name)
+
+    # ``get_running_loop`` needs Python 3.7
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_get_executor(), _call, watermarker, smart_str(unquote(url)), spec)
+
+
+async def awatermark_many(urls, args="", limit=8):
+    """
+    Watermarks many images concurrently, at most `limit` at a time, and
+    returns their URLs in the same order.  Like with ``asyncio.gather``, the
+    first exception is raised.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def watermark_one(url):
+        async with semaphore:
+            return await awatermark(url, args)
+
+    return await asyncio.gather(*[watermark_one(url) for url in urls])
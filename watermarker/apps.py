@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+from django.apps import AppConfig
+from django.core.signals import request_started
+from django.db import DatabaseError, connections
+
+from .conf import settings
+
+logger = logging.getLogger("watermarker")
+
+_preloaded = False
+_preload_lock = threading.Lock()
+
+
+class WatermarkerConfig(AppConfig):
+    name = "watermarker"
+
+    def ready(self):
+        if settings.WATERMARK_PRELOAD:
+            # import everything while the process is starting up, before a
+            # server that preloads the application forks its workers
+            from PIL import Image
+
+            from .templatetags import watermark  # noqa: F401
+
+            Image.init()
+
+            # the database should not be queried while apps are being set
+            # up, so the watermarks are prepared later on, unless the
+            # server calls ``preload`` itself
+            request_started.connect(_preload, dispatch_uid="watermarker.preload")
+
+
+def preload():
+    """
+    Prepares the watermarks of ``WATERMARK_PRELOAD`` in this process, once.
+    Call it from ``wsgi.py`` or ``asgi.py`` once the application is created,
+    so that servers that load the application before forking share the
+    prepared watermarks between their workers.
+    """
+    _preload()
+    # forked workers must not share the database connection
+    connections.close_all()
+
+
+def _preload(**kwargs):
+    global _preloaded
+
+    from .models import Watermark
+    from .templatetags.watermark import Watermarker
+
+    with _preload_lock:
+        if _preloaded or not settings.WATERMARK_PRELOAD:
+            return
+        _preloaded = True
+    request_started.disconnect(dispatch_uid="watermarker.preload")
+
+    try:
+        if settings.WATERMARK_PRELOAD is True:
+            specs = list(Watermark.objects.filter(is_active=True).values_list("name", flat=True))
+        else:
+            specs = list(settings.WATERMARK_PRELOAD)
+    except DatabaseError:
+        logger.exception("Error looking up the watermarks to preload")
+        return
+
+    watermarker = Watermarker()
+    prepared = 0
+    for args in specs:
+        try:
+            prepared += watermarker.preload(args)
+        except Exception:
+            logger.exception('Error preloading watermark "%s"' % args)
+    logger.debug("Preloaded %i watermarks" % prepared)
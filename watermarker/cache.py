@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+In-process caches used by the watermark filter.
+
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .conf import settings
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping that holds at most ``maxsize`` entries, evicting the
+    least recently used ones first.  Keeps track of hits and misses.
+
+    If ``maxbytes`` is given, entries are also evicted once the sum of their
+    sizes, as returned by ``sizeof(value)``, exceeds it.
+
+    """
+
+    def __init__(self, maxsize=128, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self.nbytes -= self._sizes.pop(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            self.nbytes += size
+            while len(self._data) > self.maxsize or (self.maxbytes is not None and self.nbytes > self.maxbytes):
+                old_key, _ = self._data.popitem(last=False)
+                self.nbytes -= self._sizes.pop(old_key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+
+def image_size(img):
+    """Roughly estimates the number of bytes used by the pixels of `img`"""
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+# maps (version, source identity, normalized filter parameters) to the URL of
+# an already generated watermarked image
+urls = LRUCache(settings.WATERMARK_URL_CACHE_SIZE)
+
+# maps (watermark, size, opacity, greyscale, rotation) to watermark images
+# that are ready to be pasted onto the target image
+overlays = LRUCache(
+    settings.WATERMARK_OVERLAY_CACHE_SIZE,
+    maxbytes=settings.WATERMARK_OVERLAY_CACHE_BYTES,
+    sizeof=image_size,
+)
+
+# maps (path, modification time, size) of source images to the fingerprints
+# of their contents
+fingerprints = LRUCache(settings.WATERMARK_URL_CACHE_SIZE)
+
+# maps names to the active ``Watermark`` objects (or ``None`` for names that
+# have no active watermark)
+watermarks = {}
+
+VERSION_KEY = "watermarker:version"
+
+_generation = 0
+_shared_version = None
+_next_poll = 0
+
+
+def _get_shared_cache():
+    if settings.WATERMARK_CACHE_BACKEND is None:
+        return None
+    return caches[settings.WATERMARK_CACHE_BACKEND]
+
+
+def _clear():
+    urls.clear()
+    overlays.clear()
+    watermarks.clear()
+
+
+def version():
+    """
+    Returns the current version of the watermarks.  It changes every time a
+    ``Watermark`` is saved or deleted, so it is part of every cache key.
+
+    When ``WATERMARK_CACHE_BACKEND`` is set, the version is shared through
+    that cache, so changes made in one process are seen by all of them.  It
+    is fetched at most once every ``WATERMARK_CACHE_POLL_INTERVAL`` seconds.
+    """
+    global _shared_version, _next_poll
+
+    shared_cache = _get_shared_cache()
+    if shared_cache is None:
+        return _generation
+
+    if _shared_version is not None and time.monotonic() < _next_poll:
+        return _generation, _shared_version
+
+    shared_version = shared_cache.get(VERSION_KEY, 0)
+    _next_poll = time.monotonic() + settings.WATERMARK_CACHE_POLL_INTERVAL
+    if shared_version != _shared_version:
+        # some other process changed the watermarks
+        _clear()
+        _shared_version = shared_version
+    return _generation, shared_version
+
+
+def invalidate():
+    """Forgets everything that depends on the current watermarks."""
+    global _generation
+    _generation += 1
+    _clear()
+
+    shared_cache = _get_shared_cache()
+    if shared_cache is not None:
+        shared_cache.add(VERSION_KEY, 0, timeout=None)
+        try:
+            shared_cache.incr(VERSION_KEY)
+        except ValueError:
+            # the key was evicted in the meantime
+            shared_cache.set(VERSION_KEY, 1, timeout=None)
+    _reset_poll()
+
+
+def _reset_poll():
+    global _shared_version
+
+    # fetch the shared version the next time it is asked for
+    _shared_version = None
+
+
+@receiver(setting_changed)
+def reset_shared_version(setting, **kwargs):
+    if setting in ("WATERMARK_CACHE_BACKEND", "WATERMARK_CACHE_POLL_INTERVAL", "CACHES"):
+        _reset_poll()
@@ -8,6 +8,40 @@ class WatermarkSettings(AppConf):
     QUALITY = 85
     OBSCURE_ORIGINAL = True
     RANDOM_POSITION_ONCE = True
+    URL_CACHE_SIZE = 4096
+    CACHE_BACKEND = None
+    CACHE_POLL_INTERVAL = 1
+    OVERLAY_CACHE_SIZE = 64
+    OVERLAY_CACHE_BYTES = 64 * 1024 * 1024
+    BACKGROUND = False
+    BACKGROUND_PLACEHOLDER = "original"
+    QUEUE = "watermarker.queues.ThreadPoolQueue"
+    QUEUE_WORKERS = None
+    LOCK_DIR = None
+    STORAGE = None
+    MANIFEST_TIMEOUT = 60
+    MANIFEST_SIZE = 4096
+    INDEX = True
+    BATCH_WORKERS = None
+    OUTPUT_FORMATS = {
+        "jpeg": {"progressive": True, "optimize": True},
+        "webp": {"method": 4},
+    }
+    NEGOTIATED_FORMATS = ("webp",)
+    SERVE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+    SENDFILE = None
+    SENDFILE_PREFIX = None
+    METRICS = False
+    METRICS_CALLBACK = None
+    RANDOM_ROTATION_STEP = 15
+    RENDER_EXECUTOR = "watermarker.executors.InlineExecutor"
+    RENDER_WORKERS = None
+    RENDER_MAX_PENDING = 64
+    RENDER_TIMEOUT = 60
+    ASYNC_WORKERS = None
+    CONTENT_HASH = False
+    PRELOAD = False
+    ANIMATION_MAX_BYTES = 256 * 1024 * 1024
 
     class Meta:
         prefix = "watermark"
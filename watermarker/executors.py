@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Executors that watermarked images are rendered by.
+
+``InlineExecutor`` renders in the calling thread.  ``ThreadExecutor`` and
+``ProcessExecutor`` render on a pool of ``WATERMARK_RENDER_WORKERS`` threads
+or processes, with at most ``WATERMARK_RENDER_MAX_PENDING`` renders waiting
+or running at once and each one given ``WATERMARK_RENDER_TIMEOUT`` seconds.
+Worker processes read the images from their files and hand back the encoded
+watermarked image, so no pixels have to be sent between processes, and they
+keep their prepared watermarks from one image to the next.
+
+"""
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent import futures
+from io import BytesIO
+
+import django
+from django.conf import ENVIRONMENT_VARIABLE
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from . import formats, utils
+from .conf import settings
+from .utils import Image
+
+
+class RenderError(Exception):
+    """Raised when an executor is too busy or takes too long to render an image"""
+
+
+class InlineExecutor(object):
+    """Renders in the calling thread"""
+
+    # whether functions run in this process, sharing its caches and storage
+    in_process = True
+
+    def run(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def shutdown(self):
+        pass
+
+
+class PoolExecutor(InlineExecutor):
+    """
+    Renders on a pool of ``concurrent.futures`` workers, waiting for at most
+    `timeout` seconds.  Raises ``RenderError`` right away if `max_pending`
+    renders are waiting or running already.
+    """
+
+    def __init__(self, max_workers=None, max_pending=None, timeout=None):
+        self.max_workers = max_workers or settings.WATERMARK_RENDER_WORKERS
+        self.max_pending = max_pending or settings.WATERMARK_RENDER_MAX_PENDING
+        self.timeout = timeout if timeout is not None else settings.WATERMARK_RENDER_TIMEOUT
+        self.executor = self.create_executor()
+        self._slots = threading.BoundedSemaphore(self.max_pending) if self.max_pending else None
+
+    def create_executor(self):
+        raise NotImplementedError
+
+    def run(self, func, *args, **kwargs):
+        if self._slots is not None and not self._slots.acquire(blocking=False):
+            raise RenderError("Too many images are being rendered already.")
+
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except Exception:
+            self._release()
+            raise
+        # the slot is taken for as long as the worker is busy, even if
+        # nobody waits for it anymore
+        future.add_done_callback(self._release)
+
+        try:
+            return future.result(self.timeout)
+        except futures.TimeoutError:
+            raise RenderError("Rendering took longer than %s seconds." % self.timeout)
+
+    def _release(self, future=None):
+        if self._slots is not None:
+            self._slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class ThreadExecutor(PoolExecutor):
+    """Renders on a pool of threads"""
+
+    def create_executor(self):
+        return futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="watermarker-render")
+
+
+class ProcessExecutor(PoolExecutor):
+    """
+    Renders in a pool of processes, which is kept for the next images.  The
+    processes set Django up from ``DJANGO_SETTINGS_MODULE``, so settings made
+    with ``settings.configure()`` are not supported.
+    """
+
+    in_process = False
+
+    def create_executor(self):
+        if sys.version_info < (3, 7):
+            # forked processes inherit the set up Django
+            return futures.ProcessPoolExecutor(max_workers=self.max_workers)
+
+        if not os.environ.get(ENVIRONMENT_VARIABLE):
+            raise ImproperlyConfigured(
+                "ProcessExecutor needs the %s environment variable to set Django up in its processes."
+                % ENVIRONMENT_VARIABLE
+            )
+        # forking a process with threads running is asking for trouble
+        return futures.ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"), initializer=django.setup
+        )
+
+
+def render(source_path, mark_path, format, options, size=None, noalpha=True, **params):
+    """
+    Renders a watermarked image and returns it encoded as `format` with the
+    encoder `options`.  Takes the parameters of ``utils.watermark``.
+    """
+    buf = BytesIO()
+    with Image.open(source_path) as target, Image.open(mark_path) as mark:
+        if formats.can_animate(target, format, size):
+            frames = utils.watermark_frames(target, mark, size=size, noalpha=noalpha, **params)
+            if "loop" in target.info:
+                options = dict(options, loop=target.info["loop"])
+            formats.save_frames((formats.convert(frame, format, noalpha) for frame in frames), buf, format, **options)
+            return buf.getvalue()
+
+        if size is not None and size != target.size:
+            target = utils.downscale(target, size)
+        im = utils.watermark(target, mark, noalpha=noalpha, **params)
+
+    im = formats.convert(im, format, noalpha)
+    im.save(buf, format=format, **options)
+    return buf.getvalue()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns the executor configured by ``WATERMARK_RENDER_EXECUTOR``"""
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = import_string(settings.WATERMARK_RENDER_EXECUTOR)()
+        return _executor
+
+
+@receiver(setting_changed)
+def reset_executor(setting, **kwargs):
+    global _executor
+
+    if setting.startswith("WATERMARK_RENDER_"):
+        with _executor_lock:
+            if _executor is not None:
+                _executor.shutdown()
+            _executor = None
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Output formats of watermarked images and their encoder options.
+
+"""
+import logging
+
+from .conf import settings
+from .utils import Image
+
+logger = logging.getLogger("watermarker")
+
+# formats that can keep the alpha channel of a watermarked image
+ALPHA_FORMATS = ("PNG", "WEBP", "AVIF", "TIFF")
+
+# formats that can hold an animation
+ANIMATED_FORMATS = ("GIF", "WEBP", "PNG")
+
+# the usual extensions of the formats that have several
+EXTENSIONS = {
+    "JPEG": ".jpg",
+    "TIFF": ".tif",
+}
+
+
+def get_format(name):
+    """
+    Returns the Pillow format of a format name or file extension, such as
+    ``"webp"`` or ``".jpg"``.  Raises ``ValueError`` if Pillow can't write it.
+    """
+    extensions = Image.registered_extensions()
+    name = name.lower()
+    format = extensions.get(name if name.startswith(".") else "." + name, name.lstrip(".").upper())
+    if format not in Image.SAVE:
+        raise ValueError('Unsupported output format "%s"!' % name)
+    return format
+
+
+def get_extension(format):
+    """Returns the file extension of a Pillow format"""
+
+    try:
+        return EXTENSIONS[format]
+    except KeyError:
+        pass
+
+    for ext, f in Image.registered_extensions().items():
+        if f == format:
+            return ext
+    raise ValueError('Unsupported output format "%s"!' % format)
+
+
+def convert(im, format, noalpha=True):
+    """
+    Converts a watermarked image to RGB if `noalpha` is set or `format` can't
+    keep the alpha channel anyway
+    """
+    if (noalpha is not False or format not in ALPHA_FORMATS) and im.mode != "RGB":
+        im = im.convert("RGB")
+    if format == "GIF":
+        # the way Pillow would save it, but at a third of the size in memory
+        im = im.convert("P", palette=Image.ADAPTIVE)
+    return im
+
+
+def can_animate(img, format, size=None):
+    """
+    Tells whether all frames of `img`, scaled to `size`, can be saved as an
+    animation in `format`.  Pillow's encoders hold every frame in memory
+    until the animation is written, as palette images for GIF and with up to
+    four bytes per pixel for other formats, which must not add up to more
+    than ``WATERMARK_ANIMATION_MAX_BYTES``.
+    """
+    if format not in ANIMATED_FORMATS or not getattr(img, "is_animated", False):
+        return False
+
+    width, height = size or img.size
+    nbytes = img.n_frames * width * height * (1 if format == "GIF" else 4)
+    if nbytes > settings.WATERMARK_ANIMATION_MAX_BYTES:
+        logger.warning(
+            "Animation of %i frames of %ix%i is too large, only the first frame is watermarked"
+            % (img.n_frames, width, height)
+        )
+        return False
+    return True
+
+
+def save_frames(frames, fp, format, **options):
+    """
+    Saves the frames of an animation, with the durations in their ``info``.
+    The encoders need all of the frames before they write anything.
+    """
+    frames = list(frames)
+    options.setdefault("duration", [frame.info.get("duration", 0) for frame in frames])
+    frames[0].save(fp, format=format, save_all=True, append_images=frames[1:], **options)
+
+
+def get_options(format, quality):
+    """
+    Returns the encoder options for a Pillow format, as configured in
+    ``WATERMARK_OUTPUT_FORMATS``
+    """
+    options = {"quality": quality}
+    for name, format_options in settings.WATERMARK_OUTPUT_FORMATS.items():
+        if name.upper() == format:
+            options.update(format_options)
+    return options
+
+
+def negotiate_format(accept, formats=None):
+    """
+    Returns the first of `formats` (``WATERMARK_NEGOTIATED_FORMATS`` by
+    default) that the ``Accept`` header of a request allows and Pillow can
+    write, if any
+    """
+    if formats is None:
+        formats = settings.WATERMARK_NEGOTIATED_FORMATS
+
+    accepted = set()
+    for media_range in accept.split(","):
+        mime, _, params = media_range.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0
+        if q > 0:
+            accepted.add(mime.strip().lower())
+
+    for name in formats:
+        try:
+            format = get_format(name)
+        except ValueError:
+            continue
+        if Image.MIME.get(format) in accepted:
+            return format
+    return None
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Locks that make sure a watermarked image is only rendered by one thread of
+one process on this host at a time.
+
+Threads of the same process wait on a lock per output path.  Processes wait
+on a lock file per output path in ``WATERMARK_LOCK_DIR``, named by hashing
+the path, which is removed again once the image is rendered.
+
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from .conf import settings
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _get_lock_dir():
+    lock_dir = settings.WATERMARK_LOCK_DIR
+    if lock_dir is None:
+        lock_dir = os.path.join(tempfile.gettempdir(), "watermarker-locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    return lock_dir
+
+
+@contextmanager
+def _thread_lock(key):
+    with _locks_lock:
+        lock, users = _locks.get(key, (None, 0))
+        if lock is None:
+            lock = threading.Lock()
+        _locks[key] = (lock, users + 1)
+
+    try:
+        with lock:
+            yield
+    finally:
+        with _locks_lock:
+            lock, users = _locks[key]
+            if users == 1:
+                del _locks[key]
+            else:
+                _locks[key] = (lock, users - 1)
+
+
+@contextmanager
+def _file_lock(key):
+    if fcntl is None:
+        yield
+        return
+
+    path = os.path.join(_get_lock_dir(), hashlib.md5(key.encode("utf-8")).hexdigest() + ".lock")
+    while True:
+        f = open(path, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                break
+        except FileNotFoundError:
+            pass
+        # the holder removed the file before letting us have it, so someone
+        # else may be holding a new one already
+        f.close()
+
+    try:
+        yield
+    finally:
+        # removed while still held, so that waiters notice
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+@contextmanager
+def lock(path):
+    """Holds the lock for rendering the file at `path`"""
+    with _thread_lock(path), _file_lock(path):
+        yield
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+
+from watermarker import cache
+from watermarker.models import WatermarkedImage
+from watermarker.storage import get_storage
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes watermarked images that were created with a watermark that "
+        "has since been changed, deactivated or deleted.  With --missing, also "
+        "drops index entries of images that are no longer in the storage."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report what would be deleted",
+        )
+        parser.add_argument(
+            "--missing",
+            action="store_true",
+            help="Also drop index entries of images that no longer exist in the storage",
+        )
+
+    def handle(self, dry_run=False, missing=False, **options):
+        storage = get_storage()
+
+        outdated = []
+        gone = []
+        current_names = set()
+        for image in WatermarkedImage.objects.select_related("watermark").iterator():
+            if image.is_outdated():
+                outdated.append(image)
+            elif missing and not storage.exists(image.name):
+                self.stdout.write("Missing %s" % image.name)
+                gone.append(image)
+            else:
+                current_names.add(image.name)
+
+        deleted = 0
+        for image in outdated:
+            # the same file may have been rendered again with the current
+            # watermark in the meantime
+            if image.name not in current_names:
+                self.stdout.write("Deleting %s" % image.name)
+                if not dry_run:
+                    storage.delete(image.name)
+                current_names.add(image.name)
+                deleted += 1
+
+        if not dry_run:
+            WatermarkedImage.objects.filter(pk__in=[image.pk for image in outdated + gone]).delete()
+            if gone:
+                # processes may still have the URLs of the missing images in memory
+                cache.invalidate()
+
+        self.stdout.write(
+            "%s %i outdated images, %i index entries."
+            % ("Would delete" if dry_run else "Deleted", deleted, len(outdated) + len(gone))
+        )
+        if missing:
+            self.stdout.write("%i images were missing." % len(gone))
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from watermarker import metrics
+from watermarker.management.commands.watermark_warm import Command as WarmCommand
+from watermarker.spec import WatermarkSpec
+from watermarker.templatetags.watermark import Watermarker
+
+PERCENTILES = (50, 90, 99)
+
+
+class Command(BaseCommand):
+    help = (
+        "Watermarks images the way the ``watermark`` template filter does and "
+        "reports how long each stage took, along with the cache hits and misses."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "filter_args",
+            help='Arguments of the watermark filter, e.g. "My Watermark,position=BR,opacity=50"',
+        )
+        parser.add_argument(
+            "patterns",
+            nargs="*",
+            help="Glob patterns of the source images, relative to MEDIA_ROOT",
+        )
+        parser.add_argument(
+            "--model",
+            help="Watermark the images of an image field, given as app_label.ModelName.field_name",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=2,
+            help="Number of times to watermark every image, the first time usually creates it",
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            help="Print the statistics as JSON",
+        )
+
+    def handle(self, filter_args, patterns, model=None, repeat=2, json=False, **options):
+        spec = WatermarkSpec.parse(filter_args)._replace(background=False)
+
+        urls = sorted(set(WarmCommand().get_urls(patterns, model)))
+        if not urls:
+            raise CommandError("No images to watermark.")
+
+        aggregator = metrics.Aggregator()
+        aggregator.connect()
+        try:
+            watermarker = Watermarker()
+            for i in range(repeat):
+                for url in urls:
+                    with metrics.span("call"):
+                        watermarker(url, spec)
+        finally:
+            aggregator.disconnect()
+
+        self.write_stats(aggregator, json)
+
+    def write_stats(self, aggregator, as_json=False):
+        summary = aggregator.summary(PERCENTILES)
+
+        if as_json:
+            self.stdout.write(json.dumps({"timings": summary, "counters": dict(aggregator.counters)}, indent=2))
+            return
+
+        columns = ["count", "mean"] + ["p%i" % p for p in PERCENTILES] + ["max"]
+        self.stdout.write("%-12s" % "stage (ms)" + "".join("%10s" % column for column in columns))
+        for stage, stats in sorted(summary.items()):
+            self.stdout.write(
+                "%-12s%10i" % (stage, stats["count"])
+                + "".join("%10.2f" % (stats[column] * 1000) for column in columns[1:])
+            )
+
+        for name, value in sorted(aggregator.counters.items()):
+            self.stdout.write("%s: %i" % (name, value))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from watermarker import cache
+from watermarker.conf import settings
+from watermarker.templatetags.watermark import Watermarker, _BatchWatermarker, parse_args
+
+
+def _init_worker(name, watermark):
+    django.setup()
+    # workers never have to look the watermark up themselves
+    cache.version()
+    cache.watermarks[name] = watermark
+
+
+def _watermark(url, params):
+    # the parent process updates the index in bulk
+    watermarker = _BatchWatermarker()
+    try:
+        return url, watermarker(url=url, **params), watermarker.index_entries, None
+    except Exception as e:
+        return url, None, [], "%s: %s" % (e.__class__.__name__, e)
+
+
+class Command(BaseCommand):
+    help = (
+        "Generates watermarked copies of many images at once, exactly as the "
+        "``watermark`` template filter would, so that the filter finds them "
+        "already there."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "filter_args",
+            help='Arguments of the watermark filter, e.g. "My Watermark,position=BR,opacity=50"',
+        )
+        parser.add_argument(
+            "patterns",
+            nargs="*",
+            help="Glob patterns of the source images, relative to MEDIA_ROOT",
+        )
+        parser.add_argument(
+            "--model",
+            help="Watermark the images of an image field, given as app_label.ModelName.field_name",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=None,
+            help="Number of worker processes (defaults to the number of CPUs)",
+        )
+        parser.add_argument(
+            "--progress",
+            type=int,
+            default=100,
+            help="Report progress every this many images, 0 to only report at the end",
+        )
+
+    def handle(self, filter_args, patterns, model=None, workers=None, progress=100, **options):
+        if progress < 0:
+            raise CommandError("--progress must not be negative.")
+
+        params = parse_args(filter_args)
+        params["background"] = False
+
+        watermark = Watermarker().get_watermark(params["name"])
+        if watermark is None:
+            raise CommandError('Watermark "%s" does not exist.' % params["name"])
+
+        urls = sorted(set(self.get_urls(patterns, model)))
+        if not urls:
+            raise CommandError("No images to watermark.")
+
+        self.stdout.write("Watermarking %i images..." % len(urls))
+
+        # worker processes must not share database connections with us
+        connections.close_all()
+
+        done = errors = 0
+        index_entries = []
+        started = time.time()
+        if sys.version_info >= (3, 7):
+            pool_options = {"initializer": _init_worker, "initargs": (params["name"], watermark)}
+        else:
+            # forked workers inherit the set up Django and the cached watermark
+            pool_options = {}
+        with ProcessPoolExecutor(max_workers=workers, **pool_options) as executor:
+            futures = [executor.submit(_watermark, url, params) for url in urls]
+            for future in as_completed(futures):
+                url, result, entries, error = future.result()
+                index_entries.extend(entries)
+                done += 1
+                if error is not None:
+                    errors += 1
+                    self.stderr.write("%s: %s" % (url, error))
+                if (progress and done % progress == 0) or done == len(urls):
+                    elapsed = time.time() - started
+                    self.stdout.write(
+                        "%i/%i images, %.1f images/s, %i errors"
+                        % (done, len(urls), done / elapsed if elapsed else 0, errors)
+                    )
+
+        if index_entries:
+            Watermarker().add_many_to_index(index_entries)
+
+        self.stdout.write("Done in %.1fs." % (time.time() - started))
+
+    def get_urls(self, patterns, model=None):
+        """Yields the media URLs of all source images"""
+
+        for pattern in patterns:
+            for path in glob.iglob(os.path.join(settings.MEDIA_ROOT, pattern), recursive=True):
+                if os.path.isfile(path) and os.sep + "watermarked" + os.sep not in path:
+                    yield self.get_url(path)
+
+        if model:
+            try:
+                app_label, model_name, field_name = model.split(".")
+                model_class = apps.get_model(app_label, model_name)
+            except (ValueError, LookupError):
+                raise CommandError('Invalid model "%s", use app_label.ModelName.field_name.' % model)
+
+            for name in model_class._default_manager.exclude(**{field_name: ""}).values_list(field_name, flat=True):
+                if name:
+                    yield self.get_url(os.path.join(settings.MEDIA_ROOT, name))
+
+    def get_url(self, path):
+        # the filter gets unquoted URLs, so this has to be one as well
+        return settings.MEDIA_URL + os.path.relpath(path, settings.MEDIA_ROOT).replace(os.sep, "/")
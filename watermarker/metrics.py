@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Timings of the stages of watermarking an image, and counters of cache hits
+and misses.
+
+Both are sent as signals, ``timing`` with the `stage` and its `duration` in
+seconds and ``counter`` with the `name` and the `value` to add.  Set
+``WATERMARK_METRICS`` to collect them in ``aggregator``, or
+``WATERMARK_METRICS_CALLBACK`` to the dotted path of a function that is
+called with the name, the value and the kind (``"timing"`` or
+``"count"``), e.g. to pass them on to statsd.
+
+"""
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from django.core.signals import setting_changed
+from django.dispatch import Signal, receiver
+from django.utils.module_loading import import_string
+
+from .conf import settings
+
+timing = Signal()
+counter = Signal()
+
+
+@contextmanager
+def span(stage):
+    """Times the enclosed block as `stage`"""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.send(sender=None, stage=stage, duration=time.perf_counter() - start)
+
+
+def incr(name, value=1):
+    """Adds `value` to the counter `name`"""
+
+    counter.send(sender=None, name=name, value=value)
+
+
+class Aggregator(object):
+    """
+    Keeps the last `maxlen` timings of every stage, and the counters, in
+    memory
+    """
+
+    def __init__(self, maxlen=10000):
+        self.maxlen = maxlen
+        self.timings = {}
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def add_timing(self, stage, duration):
+        with self._lock:
+            try:
+                self.timings[stage].append(duration)
+            except KeyError:
+                self.timings[stage] = deque([duration], maxlen=self.maxlen)
+
+    def add_count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def connect(self):
+        """Collects the metrics of this process until ``disconnect`` is called"""
+
+        timing.connect(self._on_timing, dispatch_uid=id(self))
+        counter.connect(self._on_counter, dispatch_uid=id(self))
+
+    def disconnect(self):
+        timing.disconnect(dispatch_uid=id(self))
+        counter.disconnect(dispatch_uid=id(self))
+
+    def _on_timing(self, stage, duration, **kwargs):
+        self.add_timing(stage, duration)
+
+    def _on_counter(self, name, value, **kwargs):
+        self.add_count(name, value)
+
+    def reset(self):
+        with self._lock:
+            self.timings.clear()
+            self.counters.clear()
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """
+        Returns the number of timings, their mean and maximum and the given
+        percentiles by stage
+        """
+        with self._lock:
+            timings = {stage: sorted(durations) for stage, durations in self.timings.items()}
+
+        summary = {}
+        for stage, durations in timings.items():
+            stats = {
+                "count": len(durations),
+                "mean": sum(durations) / len(durations),
+                "max": durations[-1],
+            }
+            for p in percentiles:
+                # nearest rank
+                stats["p%i" % p] = durations[max(int(round(p / 100.0 * len(durations))) - 1, 0)]
+            summary[stage] = stats
+        return summary
+
+
+aggregator = Aggregator()
+
+_callback = None
+
+
+def _get_callback():
+    global _callback
+
+    if _callback is None and settings.WATERMARK_METRICS_CALLBACK:
+        _callback = import_string(settings.WATERMARK_METRICS_CALLBACK)
+    return _callback
+
+
+@receiver(timing)
+def _dispatch_timing(stage, duration, **kwargs):
+    if settings.WATERMARK_METRICS:
+        aggregator.add_timing(stage, duration)
+    callback = _get_callback()
+    if callback is not None:
+        callback(stage, duration, "timing")
+
+
+@receiver(counter)
+def _dispatch_count(name, value, **kwargs):
+    if settings.WATERMARK_METRICS:
+        aggregator.add_count(name, value)
+    callback = _get_callback()
+    if callback is not None:
+        callback(name, value, "count")
+
+
+@receiver(setting_changed)
+def reset_callback(setting, **kwargs):
+    global _callback
+
+    if setting == "WATERMARK_METRICS_CALLBACK":
+        _callback = None
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("watermarker", "0002_auto_20210320_2145"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WatermarkedImage",
+            fields=[
+                ("id", models.AutoField(verbose_name="ID", serialize=False, auto_created=True, primary_key=True)),
+                ("key", models.CharField(max_length=40, unique=True)),
+                ("name", models.CharField(max_length=255, verbose_name="name")),
+                ("watermark_updated", models.DateTimeField()),
+                ("date_created", models.DateTimeField(auto_now_add=True)),
+                (
+                    "watermark",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="images",
+                        to="watermarker.Watermark",
+                        verbose_name="watermark",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "watermarked image",
+                "verbose_name_plural": "watermarked images",
+            },
+        ),
+    ]
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 
+from . import cache
+
 
 class Watermark(models.Model):
 
@@ -34,3 +38,41 @@ class Watermark(models.Model):
             qs.update(is_active=False)
 
         super(Watermark, self).save(*args, **kwargs)
+
+
+class WatermarkedImage(models.Model):
+    """
+    Remembers where the watermarked copy of an image was saved, so it can be
+    found without looking at the storage.  ``key`` identifies the source
+    image, the version of the watermark and the parameters used.
+    """
+
+    key = models.CharField(max_length=40, unique=True)
+    name = models.CharField(max_length=255, verbose_name=_("name"))
+    watermark = models.ForeignKey(
+        Watermark,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="images",
+        verbose_name=_("watermark"),
+    )
+    watermark_updated = models.DateTimeField()
+
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _("watermarked image")
+        verbose_name_plural = _("watermarked images")
+
+    def __str__(self):
+        return self.name
+
+    def is_outdated(self):
+        """Tells whether the watermark was changed or removed since the image was created"""
+        watermark = self.watermark
+        return watermark is None or not watermark.is_active or watermark.date_updated != self.watermark_updated
+
+
+@receiver([post_save, post_delete], sender=Watermark)
+def invalidate_watermark_cache(sender, **kwargs):
+    cache.invalidate()
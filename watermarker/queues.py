@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Queues for generating watermarked images in the background.
+
+A queue is given a key that identifies the output of a job (its path), so
+the same image is never generated twice at once: submitting a job while
+another one with the same key is still pending does nothing.
+
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+from django.utils.module_loading import import_string
+
+from .conf import settings
+
+logger = logging.getLogger("watermarker")
+
+
+class BaseQueue(object):
+    """
+    Subclasses implement ``enqueue``, which has to make sure ``run`` is
+    eventually called with the same arguments.
+    """
+
+    def __init__(self):
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, key, func, *args, **kwargs):
+        """
+        Queues ``func(*args, **kwargs)`` unless a job with the same key is
+        already pending.  Returns whether the job was queued.
+        """
+        with self._lock:
+            if key in self._pending:
+                logger.debug("Job already pending: %s" % key)
+                return False
+            self._pending.add(key)
+
+        try:
+            self.enqueue(key, func, args, kwargs)
+        except Exception:
+            self._done(key)
+            raise
+        return True
+
+    def enqueue(self, key, func, args, kwargs):
+        raise NotImplementedError
+
+    def run(self, key, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Error generating watermarked image: %s" % key)
+        finally:
+            self._done(key)
+
+    def is_pending(self, key):
+        return key in self._pending
+
+    def _done(self, key):
+        with self._lock:
+            self._pending.discard(key)
+
+
+class ImmediateQueue(BaseQueue):
+    """Runs every job right away in the calling thread"""
+
+    def enqueue(self, key, func, args, kwargs):
+        self.run(key, func, args, kwargs)
+
+
+class ThreadPoolQueue(BaseQueue):
+    """Runs jobs on a pool of ``WATERMARK_QUEUE_WORKERS`` threads"""
+
+    def __init__(self, max_workers=None):
+        super(ThreadPoolQueue, self).__init__()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or settings.WATERMARK_QUEUE_WORKERS,
+            thread_name_prefix="watermarker",
+        )
+
+    def enqueue(self, key, func, args, kwargs):
+        self.executor.submit(self.run, key, func, args, kwargs)
+
+    def run(self, key, func, args, kwargs):
+        try:
+            super(ThreadPoolQueue, self).run(key, func, args, kwargs)
+        finally:
+            # jobs may have used the database, don't leak this thread's
+            # connections
+            connections.close_all()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Returns the queue configured by ``WATERMARK_QUEUE``"""
+    global _queue
+
+    with _queue_lock:
+        if _queue is None:
+            _queue = import_string(settings.WATERMARK_QUEUE)()
+        return _queue
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+The arguments of the ``watermark`` filter, parsed once.
+
+"""
+from collections import namedtuple
+from functools import lru_cache
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from . import formats, utils
+from .conf import settings
+
+# the parameters that determine what a watermarked image looks like
+OPTION_NAMES = (
+    "position",
+    "opacity",
+    "tile",
+    "scale",
+    "greyscale",
+    "rotation",
+    "noalpha",
+    "quality",
+    "obscure",
+    "random_position_once",
+    "max_size",
+    "format",
+)
+
+_BOOLEAN_NAMES = ("tile", "greyscale", "noalpha", "obscure", "random_position_once", "background")
+
+
+class WatermarkSpec(namedtuple("WatermarkSpec", ("name",) + OPTION_NAMES + ("background",))):
+    """
+    The name of a watermark and the options to apply it with.  Specs are
+    immutable and hashable, so they can be used as cache keys, and are
+    accepted by ``Watermarker`` and ``utils.watermark`` alike.
+
+    Options that are not given default to the settings.
+    """
+
+    __slots__ = ()
+
+    def __new__(
+        cls,
+        name,
+        position=None,
+        opacity=0.5,
+        tile=False,
+        scale=1.0,
+        greyscale=False,
+        rotation=0,
+        noalpha=True,
+        quality=None,
+        obscure=None,
+        random_position_once=None,
+        max_size=None,
+        format=None,
+        background=None,
+    ):
+        if quality is None:
+            quality = settings.WATERMARK_QUALITY
+        if obscure is None:
+            obscure = settings.WATERMARK_OBSCURE_ORIGINAL
+        if random_position_once is None:
+            random_position_once = settings.WATERMARK_RANDOM_POSITION_ONCE
+        if background is None:
+            background = settings.WATERMARK_BACKGROUND
+
+        return super(WatermarkSpec, cls).__new__(
+            cls,
+            name,
+            position,
+            opacity,
+            tile,
+            scale,
+            greyscale,
+            rotation,
+            noalpha,
+            quality,
+            obscure,
+            random_position_once,
+            max_size,
+            format,
+            background,
+        )
+
+    @property
+    def options(self):
+        """The options in the order of ``OPTION_NAMES``"""
+        return self[1:len(OPTION_NAMES) + 1]
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def parse(args):
+        """
+        Turns the argument string of the ``watermark`` filter, such as
+        ``"name,position=BR,opacity=50"``, into a spec.  Raises ``ValueError``
+        for invalid values.  Specs are cached by argument string.
+        """
+        args = args.split(",")
+        name = args.pop(0)
+        params = {}
+
+        # iterate over all parameters to see what we need to do
+        for arg in args:
+            try:
+                key, value = arg.split("=")
+            except ValueError:
+                raise ValueError('Invalid watermark argument "%s"! Use key=value.' % arg)
+            key, value = key.strip(), value.strip()
+
+            if key in _BOOLEAN_NAMES:
+                params[key] = bool(_parse_int(key, value))
+            elif key == "position":
+                _validate_position(value)
+                params[key] = value
+            elif key == "opacity":
+                opacity = utils._percent(value)
+                if not 0 <= opacity <= 1:
+                    raise ValueError('Invalid opacity value "%s"! Valid values are 0 to 100.' % value)
+                params[key] = opacity
+            elif key == "scale":
+                utils._parse_scale(value)
+                params[key] = value
+            elif key == "rotation":
+                if value.lower() != "r":
+                    _parse_int(key, value)
+                params[key] = value
+            elif key == "quality":
+                quality = _parse_int(key, value)
+                if not 0 <= quality <= 100:
+                    raise ValueError('Invalid quality value "%s"! Valid values are 0 to 100.' % value)
+                params[key] = quality
+            elif key == "max_size":
+                utils.determine_size(value, (1, 1))
+                params[key] = value
+            elif key == "format":
+                params[key] = formats.get_format(value)
+
+        return WatermarkSpec(name, **params)
+
+
+def _parse_int(key, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError('Invalid %s value "%s"! Valid values are integers.' % (key, value))
+
+
+def _validate_position(value):
+    kind, left, top = utils._parse_position(value)
+    if kind is None:
+        raise ValueError(
+            'Invalid position value "%s"! Valid values are TL, TR, BR, BL, C, R '
+            "and XxY with absolute or relative (%%) coordinates." % value
+        )
+
+
+@receiver(setting_changed)
+def clear_specs(setting, **kwargs):
+    # parsed specs carry the defaults from the settings
+    if setting.startswith("WATERMARK_"):
+        WatermarkSpec.parse.cache_clear()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Access to the storage that watermarked images are saved to.
+
+"""
+import posixpath
+import threading
+import time
+
+from django.core.files.storage import FileSystemStorage
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .cache import LRUCache
+from .conf import settings
+
+
+class Manifest(object):
+    """
+    Remembers which watermarked images exist in a storage.  The contents of
+    a directory are listed with a single call the first time any file in it
+    is asked about, and again once ``timeout`` seconds have passed, just
+    like the modification times of the files.  At most `maxsize` file names
+    and as many modification times are kept.
+
+    Local storages, where checking a file is cheap, and storages that can't
+    list directories are asked about every file instead, as are directories
+    with more than `maxsize` files.
+    """
+
+    def __init__(self, storage, timeout=60, maxsize=4096):
+        self.storage = storage
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self._dirs = LRUCache(maxsize, maxbytes=maxsize, sizeof=lambda entry: len(entry[1] or ()))
+        self._modified = LRUCache(maxsize)
+        self._lock = threading.Lock()
+        try:
+            storage.path("")
+        except NotImplementedError:
+            self._local = False
+        else:
+            self._local = True
+
+    def _list(self, directory):
+        try:
+            files = self.storage.listdir(directory)[1]
+        except NotImplementedError:
+            return None
+        except (OSError, ValueError):
+            # the directory does not exist yet
+            files = []
+        return set(files)
+
+    def exists(self, name):
+        if self._local:
+            return self.storage.exists(name)
+        directory, filename = posixpath.split(name)
+
+        entry = self._dirs.get(directory)
+        if entry is None or entry[0] < time.time():
+            files = self._list(directory)
+            if files is None:
+                return self.storage.exists(name)
+            if len(files) > self.maxsize:
+                # too large to keep, remember to check its files one by one
+                files = None
+            entry = (time.time() + self.timeout, files)
+            self._dirs.set(directory, entry)
+        if entry[1] is None:
+            return self.storage.exists(name)
+        with self._lock:
+            return filename in entry[1]
+
+    def get_modified_time(self, name):
+        entry = self._modified.get(name)
+        if entry is None or entry[0] < time.time():
+            # another process may have rendered the file again
+            entry = (time.time() + self.timeout, self.storage.get_modified_time(name))
+            self._modified.set(name, entry)
+        return entry[1]
+
+    def add(self, name, modified):
+        directory, filename = posixpath.split(name)
+        entry = self._dirs.get(directory)
+        if entry is not None and entry[1] is not None:
+            with self._lock:
+                entry[1].add(filename)
+        self._modified.set(name, (time.time() + self.timeout, modified))
+
+    def clear(self):
+        self._dirs.clear()
+        self._modified.clear()
+
+
+_storage = None
+_manifest = None
+_lock = threading.Lock()
+
+
+def get_storage():
+    """
+    Returns the storage configured by ``WATERMARK_STORAGE``, or a
+    ``FileSystemStorage`` of ``MEDIA_ROOT`` if there is none.
+    """
+    global _storage
+
+    with _lock:
+        if _storage is None:
+            if settings.WATERMARK_STORAGE is None:
+                _storage = FileSystemStorage()
+            else:
+                _storage = import_string(settings.WATERMARK_STORAGE)()
+        return _storage
+
+
+def get_manifest():
+    """Returns the manifest of the configured storage"""
+    global _manifest
+
+    storage = get_storage()
+    with _lock:
+        if _manifest is None or _manifest.storage is not storage:
+            _manifest = Manifest(storage, settings.WATERMARK_MANIFEST_TIMEOUT, settings.WATERMARK_MANIFEST_SIZE)
+        return _manifest
+
+
+@receiver(setting_changed)
+def reset_storage(setting, **kwargs):
+    global _storage, _manifest
+
+    if setting.startswith("WATERMARK_MANIFEST_") or setting in ("WATERMARK_STORAGE", "MEDIA_ROOT", "MEDIA_URL"):
+        with _lock:
+            _storage = None
+            _manifest = None
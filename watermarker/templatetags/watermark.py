@@ -4,32 +4,47 @@ import errno
 import hashlib
 import logging
 import os
+import threading
 import traceback
-from datetime import datetime
-
-from PIL import Image
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 
 from urllib.parse import unquote
 from urllib.request import url2pathname
 
 from django import template
+from django.db import connections, transaction
 from django.utils.encoding import smart_str
-from django.utils.timezone import get_default_timezone, is_aware, make_aware
+from django.core.files.base import ContentFile
+from django.utils.timezone import get_default_timezone, is_aware, make_aware, now
 
-from watermarker import utils
+from watermarker import cache, executors, formats, locks, metrics, queues, utils
 from watermarker.conf import settings
-from watermarker.models import Watermark
+from watermarker.models import Watermark, WatermarkedImage
+from watermarker.spec import WatermarkSpec
+from watermarker.storage import get_manifest, get_storage
+from watermarker.utils import Image
+from watermarker.views import get_serve_url
 
 QUALITY = settings.WATERMARK_QUALITY
 OBSCURE_ORIGINAL = settings.WATERMARK_OBSCURE_ORIGINAL
 RANDOM_POSITION_ONCE = settings.WATERMARK_RANDOM_POSITION_ONCE
+BACKGROUND = settings.WATERMARK_BACKGROUND
 
 register = template.Library()
 
 logger = logging.getLogger("watermarker")
 
+# the batch being rendered by the ``watermark_batch`` tag in this thread
+_local = threading.local()
+
 
 class Watermarker(object):
+    # whether images that can't be rendered right now fall back to the
+    # original or the placeholder, rather than raising RenderError
+    fallback_on_render_error = True
+
     def __call__(
         self,
         url,
@@ -44,34 +59,105 @@ class Watermarker(object):
         quality=QUALITY,
         obscure=OBSCURE_ORIGINAL,
         random_position_once=RANDOM_POSITION_ONCE,
+        background=BACKGROUND,
+        max_size=None,
+        format=None,
     ):
         """
-        Creates a watermarked copy of an image.
+        Creates a watermarked copy of an image.  Instead of the options, a
+        ``WatermarkSpec`` can be given as `name`.
+
+        If `max_size` is given, the image is scaled down to fit into it before
+        the watermark is applied.  If `format` is given, the watermarked image
+        is saved in that format instead of the one of the original image.
+
+        If `background` is set and the watermarked image does not exist yet,
+        it is generated by the configured queue and a placeholder URL is
+        returned right away.
         """
+        if isinstance(name, WatermarkSpec):
+            return self(url, **name._asdict())
+
+        # make sure URL is a string
+        url = smart_str(url)
+        if format:
+            format = formats.get_format(format)
+
+        fstat = os.stat(self._get_filesystem_path(url))
+
+        # determine whether the parameters provided always render the same
+        # image, in which case a previous result can be reused as is
+        version = cache.version()
+        random_position = bool(position is None or str(position).lower() == "r")
+        # in the order of ``spec.OPTION_NAMES``
+        options = (
+            position,
+            opacity,
+            tile,
+            scale,
+            greyscale,
+            rotation,
+            noalpha,
+            quality,
+            obscure,
+            random_position_once,
+            max_size,
+            format,
+        )
+        deterministic = self._is_deterministic(position, rotation, random_position_once)
+        cache_key = None
+        if deterministic:
+            cache_key = (version, url, fstat.st_mtime, fstat.st_size, name) + options
+            url_path = cache.urls.get(cache_key)
+            if url_path is not None:
+                metrics.incr("cache_hit")
+                return url_path
+            metrics.incr("cache_miss")
+
         # look for the specified watermark by name.  If it's not there, go no
         # further
-        try:
-            watermark = Watermark.objects.get(name__exact=name, is_active=True)
-        except Watermark.DoesNotExist:
+        with metrics.span("lookup"):
+            watermark = self.get_watermark(name)
+        if watermark is None:
             logger.error('Watermark "%s" does not exist... Bailing out.' % name)
             return url
 
-        # make sure URL is a string
-        url = smart_str(url)
+        # see if the index knows where the watermarked image was saved
+        index_entry = None
+        if deterministic and settings.WATERMARK_INDEX:
+            index_entry = {
+                "key": self.get_index_key(url, fstat, watermark, options),
+                "watermark_id": watermark.pk,
+                "watermark_updated": watermark.date_updated,
+            }
+            with metrics.span("index"):
+                storage_name = self.get_indexed(index_entry["key"])
+            metrics.incr("index_miss" if storage_name is None else "index_hit")
+            if storage_name is not None:
+                url_path = get_storage().url(storage_name)
+                cache.urls.set(cache_key, url_path)
+                return url_path
 
-        basedir = "%s/watermarked/" % os.path.dirname(url)
+        source_path = self._get_filesystem_path(url)
+        fingerprint = None
+        if settings.WATERMARK_CONTENT_HASH:
+            # identical images share their watermarked copies, wherever they are
+            fingerprint = utils.fingerprint(source_path, fstat)
+            basedir = "%swatermarked/%s/" % (settings.MEDIA_URL, fingerprint[:2])
+        else:
+            basedir = "%s/watermarked/" % os.path.dirname(url)
         original_basename, ext = os.path.splitext(os.path.basename(url))
-
-        # open the target image file along with the watermark image
-        target = Image.open(self._get_filesystem_path(url))
-        mark = Image.open(watermark.image.path)
-
-        # determine the actual value that the parameters provided will render
-        random_position = bool(position is None or str(position).lower() == "r")
-        scale = utils.determine_scale(scale, target, mark)
-        mark = mark.resize(scale, resample=Image.LANCZOS)
-        rotation = utils.determine_rotation(rotation, mark)
-        pos = utils.determine_position(position, target, mark)
+        if format:
+            ext = formats.get_extension(format)
+
+        # read the sizes of the target image and of the watermark image, the
+        # pixels are not needed until the watermarked image is rendered
+        with metrics.span("open"), Image.open(source_path) as target, Image.open(watermark.image.path) as mark:
+            # determine the actual value that the parameters provided will render
+            size = utils.determine_size(max_size, target.size)
+            scale = utils.determine_scale(scale, utils.Dimensions(size), mark)
+            rotation = utils.determine_rotation(rotation, mark)
+            pos = utils.determine_position(position, utils.Dimensions(size), utils.Dimensions(scale))
 
         # see if we need to create only one randomly positioned watermarked
         # image
@@ -95,47 +181,372 @@ class Watermarker(object):
             "watermark": watermark.id,
             "left": pos[0],
             "top": pos[1],
-            "fstat": os.stat(self._get_filesystem_path(url)),
+            "fstat": fstat,
+            "fingerprint": fingerprint,
+            "max_size": max_size,
+            "size": size,
+            "format": format,
         }
         logger.debug("Params: %s" % params)
 
-        fname = self.generate_filename(mark, **params)
+        fname = self.generate_filename(utils.Dimensions(scale), **params)
         url_path = self.get_url_path(basedir, original_basename, ext, fname, obscure)
-        fpath = self._get_filesystem_path(url_path)
+        storage_name = self._get_storage_name(url_path)
+        url_path = get_storage().url(storage_name)
 
         logger.debug(
-            "Watermark name: %s; URL: %s; Path: %s"
+            "Watermark name: %s; URL: %s; Storage name: %s"
             % (
                 fname,
                 url_path,
-                fpath,
+                storage_name,
             )
         )
 
-        # see if the image already exists on the filesystem. If it does, use it.
-        if os.access(fpath, os.R_OK):
-            # see if the ``Watermark`` object was modified since the
-            # file was created
-            modified = make_aware(datetime.fromtimestamp(os.path.getmtime(fpath)), get_default_timezone())
-            date_updated = watermark.date_updated
-            if not is_aware(date_updated):
-                date_updated = make_aware(date_updated, get_default_timezone())
-            # only return the old file if things appear to be the same
-            if modified >= date_updated:
-                logger.info("Watermark exists and has not changed. Bailing out.")
-                return url_path
+        # see if the image already exists in the storage and the
+        # ``Watermark`` object was not modified since it was created. If
+        # so, use it.
+        with metrics.span("exists"):
+            current = self._is_current(storage_name, watermark.date_updated)
+        if current:
+            metrics.incr("storage_hit")
+            logger.info("Watermark exists and has not changed. Bailing out.")
+            if index_entry is not None:
+                self.add_to_index(index_entry, storage_name)
+            if cache_key is not None:
+                cache.urls.set(cache_key, url_path)
+            return url_path
 
         # make sure the position is in our params for the watermark
         params["position"] = pos
 
-        self.create_watermark(target, mark, fpath, **params)
+        # the prepared watermark can be reused for as long as the
+        # ``Watermark`` object stays the same
+        params["mark_key"] = (watermark.pk, watermark.date_updated)
+
+        if background:
+            queues.get_queue().submit(
+                storage_name,
+                self.render,
+                source_path,
+                watermark.image.path,
+                storage_name,
+                cache_key,
+                url_path,
+                not_before=watermark.date_updated,
+                index_entry=index_entry,
+                **params
+            )
+            logger.debug("Queued generation of watermarked image: %s" % storage_name)
+            placeholder = settings.WATERMARK_BACKGROUND_PLACEHOLDER
+            if placeholder == "original":
+                return url
+            elif placeholder == "watermarked":
+                return url_path
+            return placeholder
+
+        try:
+            self.render(
+                source_path,
+                watermark.image.path,
+                storage_name,
+                cache_key,
+                url_path,
+                not_before=watermark.date_updated,
+                index_entry=index_entry,
+                **params
+            )
+        except executors.RenderError as e:
+            if not self.fallback_on_render_error:
+                raise
+            # the executor is overloaded, which must not break the whole page
+            logger.warning("Could not render watermarked image %s: %s" % (storage_name, e))
+            placeholder = settings.WATERMARK_BACKGROUND_PLACEHOLDER
+            if placeholder in ("original", "watermarked"):
+                return url
+            return placeholder
 
         # send back the URL to the new, watermarked image
         return url_path
 
-    def _get_filesystem_path(self, url_path, basedir=settings.MEDIA_ROOT):
+    def prefetch(self, urls, args=""):
+        """
+        Looks the watermarked copies of many images up in the index with a
+        single query, so that the ``watermark`` filter finds them in the
+        cache afterwards.  Takes the same arguments as the filter and returns
+        the URLs that were found, in the cache or the index, by source URL.
+        """
+        spec = WatermarkSpec.parse(args)
+        if not settings.WATERMARK_INDEX or not self._is_deterministic(
+            spec.position, spec.rotation, spec.random_position_once
+        ):
+            return {}
+
+        watermark = self.get_watermark(spec.name)
+        if watermark is None:
+            return {}
+
+        version = cache.version()
+
+        keys = {}
+        found = {}
+        for source in urls:
+            url = smart_str(unquote(source))
+            try:
+                fstat = os.stat(self._get_filesystem_path(url))
+            except OSError:
+                continue
+            cache_key = (version, url, fstat.st_mtime, fstat.st_size, spec.name) + spec.options
+            url_path = cache.urls.get(cache_key)
+            if url_path is not None:
+                found[source] = url_path
+            else:
+                # identical images share a key with ``WATERMARK_CONTENT_HASH``
+                key = self.get_index_key(url, fstat, watermark, spec.options)
+                keys.setdefault(key, []).append((source, cache_key))
+
+        storage = get_storage()
+        for key, storage_name in self.get_indexed_many(keys).items():
+            for source, cache_key in keys[key]:
+                found[source] = storage.url(storage_name)
+                cache.urls.set(cache_key, found[source])
+        return found
+
+    def preload(self, args):
+        """
+        Looks up the watermark of the filter arguments `args` and prepares
+        it ahead of time, in every rotation if it is rotated randomly.
+        Watermarks that are scaled along with the images can't be prepared
+        before the size of the images is known.  Returns the number of
+        prepared watermarks.
+        """
+        spec = WatermarkSpec.parse(args)
+        watermark = self.get_watermark(spec.name)
+        if watermark is None:
+            logger.warning('Watermark "%s" does not exist... Not preloading it.' % spec.name)
+            return 0
+
+        with Image.open(watermark.image.path) as mark:
+            mark.load()
+            if spec.scale and utils._parse_scale(spec.scale)[0] is not None:
+                return 0
+
+            scale = utils.determine_scale(spec.scale, mark, mark)
+            if isinstance(spec.rotation, str) and spec.rotation.lower() == "r":
+                rotations = range(0, 360, settings.WATERMARK_RANDOM_ROTATION_STEP)
+            else:
+                rotations = [utils.determine_rotation(spec.rotation, mark)]
+
+            mark_key = (watermark.pk, watermark.date_updated)
+            for rotation in rotations:
+                utils._get_prepared_mark(mark, scale, spec.opacity, spec.greyscale, rotation, mark_key)
+        return len(rotations)
+
+    def batch(self, items, max_workers=None):
+        """
+        Watermarks many images at once.  `items` are ``(url, args)`` pairs,
+        with `args` as given to the filter.  Watermarked images that were
+        created before are looked up with one query per distinct `args`, and
+        the others are created concurrently on a thread pool.  Returns the
+        URLs of the watermarked images by item; items that fail are left out.
+        """
+        items = list(dict.fromkeys(items))
+        by_args = {}
+        for url, args in items:
+            by_args.setdefault(args, []).append(url)
+
+        found = {}
+        for args, urls in by_args.items():
+            # workers never have to look the watermark up themselves
+            self.get_watermark(WatermarkSpec.parse(args).name)
+            for url, url_path in self.prefetch(urls, args).items():
+                found[url, args] = url_path
+
+        missing = [item for item in items if item not in found]
+        if not missing:
+            return found
+
+        # the index is updated from this thread, all in one go
+        workers = _BatchWatermarker()
+
+        def work(item):
+            url, args = item
+            try:
+                return item, workers(unquote(url), WatermarkSpec.parse(args))
+            except Exception:
+                logger.exception("Error watermarking image: %s" % url)
+                return item, None
+            finally:
+                # don't leak the connections of the pool's threads
+                connections.close_all()
+
+        with ThreadPoolExecutor(
+            max_workers=max_workers or settings.WATERMARK_BATCH_WORKERS, thread_name_prefix="watermarker"
+        ) as executor:
+            for item, url_path in executor.map(work, missing):
+                if url_path is not None:
+                    found[item] = url_path
+
+        if workers.index_entries:
+            self.add_many_to_index(workers.index_entries)
+        return found
+
+    def render(
+        self, source_path, mark_path, name, cache_key=None, url_path=None, not_before=None, index_entry=None, **params
+    ):
+        """
+        Renders the watermarked image and saves it to the storage as `name`.
+        If a cache key is given, `url_path` is remembered as the URL of the
+        result, and if an index entry is given, the result is added to the
+        index.
+
+        Only one thread on this host renders a particular file at a time.
+        Others wait for it and, if `not_before` is given, skip rendering when
+        the file they find was created at or after that time.
+        """
+        with locks.lock(name):
+            if not_before is not None and self._is_current(name, not_before, use_manifest=False):
+                logger.debug("Watermarked image was rendered in the meantime: %s" % name)
+            else:
+                metrics.incr("rendered")
+                with metrics.span("render"):
+                    executor = executors.get_executor()
+                    if executor.in_process:
+                        executor.run(self.create, source_path, mark_path, name, **params)
+                    else:
+                        format = formats.get_format(params.pop("format", None) or os.path.splitext(name)[1])
+                        options = formats.get_options(format, params.pop("quality", QUALITY))
+                        data = executor.run(executors.render, source_path, mark_path, format, options, **params)
+                        with metrics.span("write"):
+                            self.save_data(data, name)
+
+        if index_entry is not None:
+            self.add_to_index(index_entry, name)
+        if cache_key is not None:
+            cache.urls.set(cache_key, url_path)
+
+    def get_source_key(self, url, fstat):
+        """
+        Identifies the source image by its URL, modification time and size, or
+        by the fingerprint of its contents if ``WATERMARK_CONTENT_HASH`` is set
+        """
+        if settings.WATERMARK_CONTENT_HASH:
+            return (utils.fingerprint(self._get_filesystem_path(url), fstat),)
+        return (url, fstat.st_mtime, fstat.st_size)
+
+    def get_index_key(self, url, fstat, watermark, options):
+        """
+        Comes up with the key of the watermarked image in the index, which
+        changes along with the source image, the watermark and the options
+        """
+        key = self.get_source_key(url, fstat) + (watermark.pk, watermark.date_updated.isoformat()) + tuple(options)
+        return hashlib.sha1(smart_str(repr(key)).encode("utf-8")).hexdigest()
+
+    def get_indexed(self, key):
+        """Returns the storage name of the indexed watermarked image, if any"""
+
+        return WatermarkedImage.objects.filter(key=key).values_list("name", flat=True).first()
+
+    def get_indexed_many(self, keys):
+        """Returns the storage names of the indexed watermarked images by key"""
+
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            found.update(WatermarkedImage.objects.filter(key__in=keys[i:i + 500]).values_list("key", "name"))
+        return found
+
+    def add_to_index(self, entry, name):
+        """Adds a watermarked image saved as `name` to the index"""
+
+        defaults = dict(entry, name=name)
+        WatermarkedImage.objects.update_or_create(key=defaults.pop("key"), defaults=defaults)
+
+    def add_many_to_index(self, entries, batch_size=500):
+        """Adds many watermarked images to the index, given as entries with their names"""
+
+        # the same image may have been rendered for several sources
+        entries = list({entry["key"]: entry for entry in entries}.values())
+        for i in range(0, len(entries), batch_size):
+            batch = entries[i:i + batch_size]
+            with transaction.atomic():
+                WatermarkedImage.objects.filter(key__in=[entry["key"] for entry in batch]).delete()
+                WatermarkedImage.objects.bulk_create([WatermarkedImage(**entry) for entry in batch])
+
+    def _is_current(self, name, date_updated, use_manifest=True):
+        """
+        Determines whether `name` exists in the storage and was modified at or
+        after `date_updated`.  Unless told otherwise, the manifest is asked
+        instead of the storage itself.
+        """
+        source = get_manifest() if use_manifest else get_storage()
+        if not source.exists(name):
+            return False
+
+        try:
+            modified = source.get_modified_time(name)
+        except NotImplementedError:
+            # there is no way to tell, so better not render it over and over
+            return True
+
+        if not is_aware(modified):
+            modified = make_aware(modified, get_default_timezone())
+        if not is_aware(date_updated):
+            date_updated = make_aware(date_updated, get_default_timezone())
+        return modified >= date_updated
+
+    def _is_deterministic(self, position, rotation, random_position_once):
+        """Determines whether the parameters provided always render the same image"""
+
+        random_position = bool(position is None or str(position).lower() == "r")
+        random_rotation = bool(isinstance(rotation, str) and rotation.lower() == "r")
+        return not random_rotation and (random_position_once or not random_position)
+
+    def get_watermark(self, name):
+        """Returns the active watermark with the specified name, if any"""
+
+        try:
+            return cache.watermarks[name]
+        except KeyError:
+            pass
+
+        try:
+            watermark = Watermark.objects.get(name__exact=name, is_active=True)
+        except Watermark.DoesNotExist:
+            watermark = None
+
+        cache.watermarks[name] = watermark
+        return watermark
+
+    async def aget_watermark(self, name):
+        """Returns the active watermark with the specified name, if any, without blocking"""
+
+        try:
+            return cache.watermarks[name]
+        except KeyError:
+            pass
+
+        queryset = Watermark.objects.filter(is_active=True)
+        try:
+            if hasattr(queryset, "aget"):
+                watermark = await queryset.aget(name__exact=name)
+            else:  # Django < 4.1
+                # Django 2.2 does not depend on asgiref
+                from asgiref.sync import sync_to_async
+
+                watermark = await sync_to_async(queryset.get)(name__exact=name)
+        except Watermark.DoesNotExist:
+            watermark = None
+
+        cache.watermarks[name] = watermark
+        return watermark
+
+    def _get_filesystem_path(self, url_path, basedir=None):
         """Makes a filesystem path from the specified URL path"""
 
+        if basedir is None:
+            basedir = settings.MEDIA_ROOT
+
         if url_path.startswith(settings.MEDIA_URL):
             url_path = url_path[len(settings.MEDIA_URL):]  # strip media root url
 
@@ -162,6 +573,13 @@ class Watermarker(object):
             "p%(position)s",
         ]
 
+        if kwargs.get("fingerprint", None):
+            # the name must not depend on where the source image is, nor on
+            # when it was written
+            params[0] = "%(fingerprint)s"
+            params.remove("fm%(st_mtime)i")
+            params.remove("fz%(st_size)i")
+
         scale = kwargs.get("scale", None)
         if scale and scale != mark.size:
             params.append("_s%i" % (float(kwargs["scale"][0]) / mark.size[0] * 100))
@@ -169,6 +587,12 @@ class Watermarker(object):
         if kwargs.get("tile", None):
             params.append("_tiled")
 
+        if kwargs.get("max_size", None):
+            params.append("_m%ix%i" % kwargs["size"])
+
+        if kwargs.get("format", None):
+            params.append("_f%s" % kwargs["format"].lower())
+
         # make thumbnail filename
         filename = "%s%s" % ("_".join(params), kwargs["ext"])
 
@@ -190,9 +614,20 @@ class Watermarker(object):
             logger.debug("Not obscuring original image name.")
             url_path = os.path.join(basedir, hash, original_basename + ext)
 
-        # make sure the destination directory exists
+        return url_path
+
+    def _get_storage_name(self, url_path):
+        """Makes a storage name from the specified URL path"""
+
+        if url_path.startswith(settings.MEDIA_URL):
+            url_path = url_path[len(settings.MEDIA_URL):]  # strip media root url
+
+        return url_path.lstrip("/")
+
+    def _make_dirs(self, fpath):
+        """Makes sure the destination directory exists"""
+
         try:
-            fpath = self._get_filesystem_path(url_path)
             os.makedirs(os.path.dirname(fpath))
         except OSError as e:
             if e.errno == errno.EEXIST:
@@ -203,17 +638,180 @@ class Watermarker(object):
         else:
             logger.debug("Created directory: %s" % os.path.dirname(fpath))
 
-        return url_path
-
-    def create_watermark(self, target, mark, fpath, quality=QUALITY, **kwargs):
-        """Create the watermarked image on the filesystem"""
+    def create(self, source_path, mark_path, name, size=None, **params):
+        """Creates the watermarked image of the files given in the storage"""
 
-        im = utils.watermark(target, mark, **kwargs)
-        if not kwargs.get("noalpha", True) is False:
-            im = im.convert("RGB")
-        im.save(fpath, quality=quality)
+        with Image.open(source_path) as target, Image.open(mark_path) as mark:
+            if utils.is_animated(target):
+                # frames are decoded and scaled one at a time
+                params["size"] = size
+            else:
+                with metrics.span("decode"):
+                    if size is not None and size != target.size:
+                        target = utils.downscale(target, size)
+                    else:
+                        target.load()
+            self.create_watermark(target, mark, name, **params)
+
+    def create_watermark(self, target, mark, name, quality=QUALITY, format=None, **kwargs):
+        """Create the watermarked image in the storage"""
+
+        format = formats.get_format(format or os.path.splitext(name)[1])
+        if formats.can_animate(target, format, kwargs.get("size")):
+            self.create_animation(target, mark, name, format, formats.get_options(format, quality), **kwargs)
+            return None
+
+        size = kwargs.pop("size", None)
+        if size is not None and size != target.size:
+            # only the first frame of an animation is kept
+            target = utils.downscale(target, size)
+
+        with metrics.span("composite"):
+            im = utils.watermark(target, mark, **kwargs)
+        im = formats.convert(im, format, kwargs.get("noalpha", True))
+
+        with metrics.span("encode"):
+            self.save(im, name, format=format, **formats.get_options(format, quality))
         return im
 
+    def create_animation(self, target, mark, name, format, options, **kwargs):
+        """Creates a watermarked copy of every frame of `target` in the storage"""
+
+        noalpha = kwargs.get("noalpha", True)
+        if "loop" in target.info:
+            options["loop"] = target.info["loop"]
+
+        # the encoder needs all frames at once, so they are kept converted,
+        # which takes the least memory
+        with metrics.span("composite"):
+            frames = [
+                formats.convert(frame, format, noalpha) for frame in utils.watermark_frames(target, mark, **kwargs)
+            ]
+
+        with metrics.span("encode"):
+            self._write(name, lambda f: formats.save_frames(frames, f, format, **options))
+
+    def save(self, im, name, **options):
+        """Saves the image to the storage as `name`, replacing any existing file"""
+
+        options.setdefault("format", Image.registered_extensions()[os.path.splitext(name)[1].lower()])
+        self._write(name, lambda f: im.save(f, **options))
+
+    def save_data(self, data, name):
+        """Saves an encoded image to the storage as `name`, replacing any existing file"""
+
+        self._write(name, lambda f: f.write(data))
+
+    def _write(self, name, write):
+        storage = get_storage()
+        try:
+            fpath = storage.path(name)
+        except NotImplementedError:
+            fpath = None
+
+        if fpath is not None:
+            # write to a temporary file first and move it into place, so
+            # that nobody ever sees a partially written image
+            self._make_dirs(fpath)
+            root, ext = os.path.splitext(fpath)
+            tmp_path = "%s.%s.tmp%s" % (root, uuid.uuid4().hex, ext)
+            try:
+                with open(tmp_path, "wb") as f:
+                    write(f)
+                os.replace(tmp_path, fpath)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        else:
+            buf = BytesIO()
+            write(buf)
+            if storage.exists(name):
+                storage.delete(name)
+            storage.save(name, ContentFile(buf.getvalue()))
+
+        get_manifest().add(name, now())
+
+
+class _BatchWatermarker(Watermarker):
+    """
+    Leaves the index to the caller, which looks images up and adds them in
+    bulk
+    """
+
+    def __init__(self):
+        self.index_entries = []
+
+    def get_indexed(self, key):
+        return None
+
+    def add_to_index(self, entry, name):
+        self.index_entries.append(dict(entry, name=name))
+
+
+class _Batch(object):
+    """Collects the images of a ``watermark_batch`` tag, then hands out their URLs"""
+
+    def __init__(self):
+        self.items = []
+        self.urls = None
+
+    def watermark(self, url, args):
+        if self.urls is None:
+            self.items.append((url, args))
+            return url
+        try:
+            return self.urls[url, args]
+        except KeyError:
+            return Watermarker()(unquote(url), WatermarkSpec.parse(args))
+
+
+class WatermarkBatchNode(template.Node):
+    def __init__(self, nodelist):
+        self.nodelist = nodelist
+
+    def render(self, context):
+        batch = _Batch()
+        previous = getattr(_local, "batch", None)
+        _local.batch = batch
+        try:
+            # render once to find out which images are watermarked, leaving
+            # the state of tags such as ``cycle`` as it was
+            with context.render_context.push(), context.push():
+                self.nodelist.render(context)
+            batch.urls = Watermarker().batch(batch.items)
+            return self.nodelist.render(context)
+        finally:
+            _local.batch = previous
+
+
+@register.tag
+def watermark_batch(parser, token):
+    """
+    Watermarks all images of the enclosed block at once.  The block is
+    rendered twice, first to collect the images that the ``watermark``
+    filter is applied to.
+
+        {% watermark_batch %}
+            {% for photo in photos %}
+                <img src="{{ photo.image.url|watermark:'My Watermark,position=br' }}">
+            {% endfor %}
+        {% endwatermark_batch %}
+
+    """
+    nodelist = parser.parse(("endwatermark_batch",))
+    parser.delete_first_token()
+    return WatermarkBatchNode(nodelist)
+
+
+def parse_args(args):
+    """
+    Turns the argument string of the ``watermark`` filter, such as
+    ``"name,position=BR,opacity=50"``, into keyword arguments for
+    ``Watermarker``.
+    """
+    return WatermarkSpec.parse(args)._asdict()
+
 
 @register.filter
 def watermark(url, args=""):
@@ -221,48 +819,18 @@ def watermark(url, args=""):
     Returns the URL to a watermarked copy of the image specified.
 
     """
-    # initialize some variables
-    args = args.split(",")
+    batch = getattr(_local, "batch", None)
+    if batch is not None:
+        return batch.watermark(url, args)
 
-    params = dict(
-        name=args.pop(0),
-        opacity=0.5,
-        tile=False,
-        scale=1.0,
-        greyscale=False,
-        rotation=0,
-        position=None,
-        noalpha=True,
-        quality=QUALITY,
-        obscure=OBSCURE_ORIGINAL,
-        random_position_once=RANDOM_POSITION_ONCE,
-    )
-
-    params["url"] = unquote(url)
-
-    # iterate over all parameters to see what we need to do
-    for arg in args:
-        key, value = arg.split("=")
-        key, value = key.strip(), value.strip()
-        if key == "position":
-            params["position"] = value
-        elif key == "opacity":
-            params["opacity"] = utils._percent(value)
-        elif key == "tile":
-            params["tile"] = bool(int(value))
-        elif key == "scale":
-            params["scale"] = value
-        elif key == "greyscale":
-            params["greyscale"] = bool(int(value))
-        elif key == "rotation":
-            params["rotation"] = value
-        elif key == "noalpha":
-            params["noalpha"] = bool(int(value))
-        elif key == "quality":
-            params["quality"] = int(value)
-        elif key == "obscure":
-            params["obscure"] = bool(int(value))
-        elif key == "random_position_once":
-            params["random_position_once"] = bool(int(value))
-
-    return Watermarker()(**params)
+    return Watermarker()(unquote(url), WatermarkSpec.parse(args))
+
+
+@register.filter
+def watermark_url(url, args=""):
+    """
+    Returns the URL of a view that serves a watermarked copy of the image
+    specified, without creating it or even looking it up.
+
+    """
+    return get_serve_url(unquote(url), args)
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+from django.test import SimpleTestCase
+
+from ..cache import LRUCache
+
+
+class LRUCacheTestCase(SimpleTestCase):
+    def test_maxsize(self):
+        lru = LRUCache(2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        lru.get("a")
+        lru.set("c", 3)
+        self.assertIn("a", lru)
+        self.assertNotIn("b", lru)
+        self.assertEqual((lru.hits, lru.misses), (1, 0))
+
+    def test_maxbytes(self):
+        lru = LRUCache(10, maxbytes=5, sizeof=len)
+        lru.set("a", "xxx")
+        lru.set("b", "xxx")
+        self.assertNotIn("a", lru)
+        self.assertEqual(lru.nbytes, 3)
+        lru.set("c", "xxxxxx")
+        self.assertNotIn("c", lru)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from ..executors import RenderError, ThreadExecutor
+
+
+class ThreadExecutorTestCase(SimpleTestCase):
+    def setUp(self):
+        self.executor = ThreadExecutor(max_workers=1, max_pending=1, timeout=5)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_run(self):
+        self.assertEqual(self.executor.run(sum, [1, 2]), 3)
+        self.assertEqual(self.executor.run(sum, [3, 4]), 7)
+
+    def test_max_pending(self):
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        thread = threading.Thread(target=self.executor.run, args=(block,))
+        thread.start()
+        started.wait()
+        with self.assertRaises(RenderError):
+            self.executor.run(sum, [1, 2])
+        release.set()
+        thread.join()
+        # the slot is given back right after the result was handed over
+        self.assertTrue(self.executor._slots.acquire(timeout=5))
+        self.executor._slots.release()
+        self.assertEqual(self.executor.run(sum, [1, 2]), 3)
+
+    def test_timeout(self):
+        self.executor.timeout = 0.01
+        with self.assertRaises(RenderError):
+            self.executor.run(time.sleep, 0.5)
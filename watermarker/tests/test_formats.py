@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+from django.test import SimpleTestCase, override_settings
+
+from ..formats import get_extension, get_format, get_options, negotiate_format
+
+
+class FormatsTestCase(SimpleTestCase):
+    def test_get_format(self):
+        self.assertEqual(get_format("webp"), "WEBP")
+        self.assertEqual(get_format(".JPG"), "JPEG")
+        self.assertEqual(get_extension("JPEG"), ".jpg")
+        with self.assertRaises(ValueError):
+            get_format("doc")
+
+    @override_settings(WATERMARK_OUTPUT_FORMATS={"JPEG": {"progressive": True, "quality": 70}})
+    def test_get_options(self):
+        self.assertEqual(get_options("JPEG", 85), {"progressive": True, "quality": 70})
+        self.assertEqual(get_options("PNG", 85), {"quality": 85})
+
+    def test_negotiate_format(self):
+        self.assertEqual(negotiate_format("image/webp,*/*;q=0.8", ("bogus", "png", "webp")), "WEBP")
+        self.assertEqual(negotiate_format("image/webp;q=0, image/png", ("webp", "png")), "PNG")
+        self.assertIsNone(negotiate_format("text/html", ("webp",)))
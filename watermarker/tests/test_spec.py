@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from django.test import SimpleTestCase, override_settings
+
+from ..spec import WatermarkSpec
+
+
+class WatermarkSpecTestCase(SimpleTestCase):
+    def test_parse(self):
+        spec = WatermarkSpec.parse("test, position=BR, opacity=50, tile=1, rotation=R")
+        self.assertEqual(spec.name, "test")
+        self.assertEqual(spec.position, "BR")
+        self.assertEqual(spec.opacity, 0.5)
+        self.assertIs(spec.tile, True)
+        self.assertEqual(spec.rotation, "R")
+        self.assertEqual(spec, WatermarkSpec("test", position="BR", opacity=0.5, tile=True, rotation="R"))
+
+    def test_cached(self):
+        self.assertIs(WatermarkSpec.parse("test,position=BR"), WatermarkSpec.parse("test,position=BR"))
+
+    def test_defaults_follow_settings(self):
+        WatermarkSpec.parse("test")
+        with override_settings(WATERMARK_QUALITY=70):
+            self.assertEqual(WatermarkSpec.parse("test").quality, 70)
+
+    def test_invalid(self):
+        for args in (
+            "test,opacity=150",
+            "test,opacity=half",
+            "test,position=middle",
+            "test,scale=R1000%",
+            "test,rotation=left",
+            "test,tile=yes",
+            "test,max_size=big",
+            "test,position",
+        ):
+            with self.assertRaises(ValueError, msg=args):
+                WatermarkSpec.parse(args)
@@ -0,0 +1,523 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+import django
+from django.core.cache import caches
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.core.management import call_command
+from django.template import Context, Template
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
+from PIL import Image
+
+from .. import apps, cache, locks, queues
+from ..aio import awatermark, awatermark_many
+from ..executors import InlineExecutor, RenderError
+from ..models import Watermark, WatermarkedImage
+from ..storage import Manifest, get_manifest, get_storage
+from ..templatetags.watermark import Watermarker, watermark, watermark_url
+
+TESTS_DIR = os.path.dirname(__file__)
+
+
+class MemoryStorage(Storage):
+    """Keeps files in a dictionary, can't tell their filesystem paths"""
+
+    files = {}
+
+    def __init__(self):
+        self.listdir_calls = 0
+
+    def _save(self, name, content):
+        self.files[name] = (content.read(), now())
+        return name
+
+    def _open(self, name, mode="rb"):
+        return ContentFile(self.files[name][0], name=name)
+
+    def exists(self, name):
+        return name in self.files
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+    def listdir(self, path):
+        self.listdir_calls += 1
+        prefix = path.rstrip("/") + "/"
+        names = [name[len(prefix):] for name in self.files if name.startswith(prefix)]
+        return [], [name for name in names if "/" not in name]
+
+    def get_modified_time(self, name):
+        return self.files[name][1]
+
+    def url(self, name):
+        return "https://cdn.example.com/" + name
+
+
+class DeferredQueue(queues.BaseQueue):
+    """Holds on to jobs until they are explicitly run"""
+
+    def __init__(self):
+        super(DeferredQueue, self).__init__()
+        self.jobs = []
+
+    def enqueue(self, key, func, args, kwargs):
+        self.jobs.append((key, func, args, kwargs))
+
+    def run_all(self):
+        while self.jobs:
+            self.run(*self.jobs.pop(0))
+
+
+class WatermarkFilterTestCase(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+        settings_override = override_settings(MEDIA_ROOT=self.media_root, MEDIA_URL="/media/")
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        shutil.copy(os.path.join(TESTS_DIR, "test.png"), os.path.join(self.media_root, "test.png"))
+        with open(os.path.join(TESTS_DIR, "overlay.png"), "rb") as f:
+            self.mark = Watermark(name="test")
+            self.mark.image.save("overlay.png", File(f))
+
+        cache.invalidate()
+
+    def test_creates_file(self):
+        url = watermark("/media/test.png", "test,position=BR,opacity=50")
+        self.assertTrue(url.startswith("/media/watermarked/"))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, url[len("/media/"):])))
+
+    def test_missing_watermark(self):
+        self.assertEqual(watermark("/media/test.png", "missing"), "/media/test.png")
+
+    def test_cache_hit(self):
+        url = watermark("/media/test.png", "test,position=BR,opacity=50")
+        with self.assertNumQueries(0), mock.patch("PIL.Image.open") as mocked:
+            self.assertEqual(watermark("/media/test.png", "test,position=BR,opacity=50"), url)
+        self.assertFalse(mocked.called)
+
+    @override_settings(WATERMARK_INDEX=False)
+    def test_cache_invalidated_on_save(self):
+        watermark("/media/test.png", "test,position=BR,opacity=50")
+        self.mark.save()
+        with self.assertNumQueries(1):
+            watermark("/media/test.png", "test,position=BR,opacity=50")
+
+    @override_settings(WATERMARK_INDEX=False)
+    def test_watermark_lookup_cached(self):
+        shutil.copy(os.path.join(self.media_root, "test.png"), os.path.join(self.media_root, "other.png"))
+        watermark("/media/test.png", "test,position=BR")
+        with self.assertNumQueries(0):
+            watermark("/media/other.png", "test,position=BR")
+
+    @override_settings(
+        WATERMARK_INDEX=False,
+        WATERMARK_CACHE_BACKEND="default",
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    )
+    def test_shared_version(self):
+        watermark("/media/test.png", "test,position=BR")
+        self.assertEqual(len(cache.watermarks), 1)
+        # simulate a watermark being changed by another process
+        caches["default"].set(cache.VERSION_KEY, 42)
+        with mock.patch.object(caches["default"], "get", wraps=caches["default"].get) as mocked:
+            for i in range(10):
+                watermark("/media/test.png", "test,position=BR")
+        # the shared version is fetched at most once a second
+        self.assertEqual(mocked.call_count, 0)
+        self.assertEqual(len(cache.watermarks), 1)
+
+        with mock.patch("watermarker.cache.time.monotonic", return_value=time.monotonic() + 2):
+            with self.assertNumQueries(1):
+                watermark("/media/test.png", "test,position=BR")
+
+    def test_random_rotation_not_cached(self):
+        watermark("/media/test.png", "test,position=BR,rotation=R")
+        self.assertEqual(len(cache.urls), 0)
+
+    def test_background(self):
+        queue = DeferredQueue()
+        with mock.patch("watermarker.queues._queue", queue):
+            self.assertEqual(watermark("/media/test.png", "test,position=BR,background=1"), "/media/test.png")
+            self.assertEqual(watermark("/media/test.png", "test,position=BR,background=1"), "/media/test.png")
+            self.assertEqual(len(queue.jobs), 1)
+
+            queue.run_all()
+            url = watermark("/media/test.png", "test,position=BR,background=1")
+        self.assertTrue(url.startswith("/media/watermarked/"))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, url[len("/media/"):])))
+
+    def test_warm(self):
+        os.mkdir(os.path.join(self.media_root, "photos"))
+        for i in range(3):
+            shutil.copy(
+                os.path.join(self.media_root, "test.png"), os.path.join(self.media_root, "photos", "%i.png" % i)
+            )
+
+        out = StringIO()
+        call_command("watermark_warm", "test,position=BR", "photos/*.png", workers=2, progress=0, stdout=out)
+        self.assertIn("3/3 images", out.getvalue())
+        self.assertIn("0 errors", out.getvalue())
+
+        with mock.patch("watermarker.templatetags.watermark.Watermarker.render") as mocked:
+            for i in range(3):
+                watermark("/media/photos/%i.png" % i, "test,position=BR")
+        self.assertFalse(mocked.called)
+
+    @override_settings(WATERMARK_INDEX=False)
+    def test_single_flight(self):
+        create_watermark = Watermarker.create_watermark
+
+        def slow_create_watermark(*args, **kwargs):
+            time.sleep(0.1)
+            return create_watermark(*args, **kwargs)
+
+        # threads cannot see the data of this test's transaction
+        Watermarker().get_watermark("test")
+
+        urls = []
+        with mock.patch.object(
+            Watermarker, "create_watermark", side_effect=slow_create_watermark, autospec=True
+        ) as mocked:
+            threads = [
+                threading.Thread(target=lambda: urls.append(watermark("/media/test.png", "test,position=BR")))
+                for i in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(mocked.call_count, 1)
+        self.assertEqual(len(set(urls)), 1)
+        # no temporary files are left behind
+        fpath = os.path.join(self.media_root, urls[0][len("/media/"):])
+        self.assertEqual(os.listdir(os.path.dirname(fpath)), [os.path.basename(fpath)])
+
+    def test_lock(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+
+        def render_other():
+            with locks.lock("other.png"):
+                locked.append(len(os.listdir(lock_dir)))
+
+        locked = []
+        with override_settings(WATERMARK_LOCK_DIR=lock_dir):
+            with locks.lock("image.png"):
+                # other outputs do not wait for this one
+                thread = threading.Thread(target=render_other)
+                thread.start()
+                thread.join(5)
+                self.assertEqual(locked, [2])
+        # lock files are removed once released
+        self.assertEqual(os.listdir(lock_dir), [])
+
+    @override_settings(WATERMARK_INDEX=False, WATERMARK_STORAGE="watermarker.tests.test_templatetags.MemoryStorage")
+    def test_storage(self):
+        MemoryStorage.files.clear()
+        shutil.copy(os.path.join(self.media_root, "test.png"), os.path.join(self.media_root, "other.png"))
+
+        url = watermark("/media/test.png", "test,position=BR")
+        self.assertTrue(url.startswith("https://cdn.example.com/watermarked/"))
+        self.assertIn(url[len("https://cdn.example.com/"):], MemoryStorage.files)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, "watermarked")))
+
+        # both images are looked up with a single listing of their directory
+        watermark("/media/other.png", "test,position=BR")
+        cache.invalidate()
+        get_manifest().clear()
+        storage = get_storage()
+        storage.listdir_calls = 0
+        with mock.patch.object(storage, "exists", side_effect=AssertionError):
+            self.assertEqual(watermark("/media/test.png", "test,position=BR"), url)
+            watermark("/media/other.png", "test,position=BR")
+        self.assertEqual(storage.listdir_calls, 1)
+
+    def test_index(self):
+        url = watermark("/media/test.png", "test,position=BR")
+        self.assertEqual(WatermarkedImage.objects.get().name, url[len("/media/"):])
+
+        # a fresh process finds the image without looking at the storage
+        cache.invalidate()
+        get_manifest().clear()
+        with mock.patch.object(get_storage(), "exists", side_effect=AssertionError), mock.patch(
+            "PIL.Image.open"
+        ) as mocked, self.assertNumQueries(2):
+            self.assertEqual(watermark("/media/test.png", "test,position=BR"), url)
+        self.assertFalse(mocked.called)
+
+    @mock.patch.dict(MemoryStorage.files, clear=True)
+    def test_manifest(self):
+        storage = MemoryStorage()
+        manifest = Manifest(storage, timeout=60, maxsize=2)
+        for i in range(3):
+            storage.save("dir%i/image.png" % i, ContentFile(b""))
+            self.assertTrue(manifest.exists("dir%i/image.png" % i))
+        self.assertEqual(len(manifest._dirs), 2)
+        self.assertFalse(manifest.exists("dir2/other.png"))
+        self.assertEqual(storage.listdir_calls, 3)
+
+        # directories with more files than are kept are checked file by file
+        for name in ("other.png", "third.png"):
+            storage.save("dir2/" + name, ContentFile(b""))
+        manifest.clear()
+        for i in range(2):
+            self.assertTrue(manifest.exists("dir2/other.png"))
+        self.assertEqual(storage.listdir_calls, 4)
+
+        # local storages are never listed
+        storage = get_storage()
+        manifest = Manifest(storage, timeout=0, maxsize=2)
+        with mock.patch.object(storage, "listdir") as listdir:
+            storage.save("dir0/image.png", ContentFile(b""))
+            self.assertTrue(manifest.exists("dir0/image.png"))
+        listdir.assert_not_called()
+
+        # modification times expire
+        manifest.add("dir0/image.png", now().replace(year=2000))
+        self.assertEqual(manifest.get_modified_time("dir0/image.png"), storage.get_modified_time("dir0/image.png"))
+
+    def test_prefetch(self):
+        shutil.copy(os.path.join(self.media_root, "test.png"), os.path.join(self.media_root, "other.png"))
+        urls = [watermark(url, "test,position=BR") for url in ("/media/test.png", "/media/other.png")]
+
+        cache.invalidate()
+        Watermarker().get_watermark("test")
+        with self.assertNumQueries(1):
+            found = Watermarker().prefetch(["/media/test.png", "/media/other.png"], "test,position=BR")
+        self.assertEqual(found, {"/media/test.png": urls[0], "/media/other.png": urls[1]})
+        with self.assertNumQueries(0):
+            self.assertEqual(watermark("/media/other.png", "test,position=BR"), urls[1])
+
+    def test_gc(self):
+        old_url = watermark("/media/test.png", "test,position=BR")
+        watermark("/media/test.png", "test,position=TL")
+        self.mark.save()
+        new_url = watermark("/media/test.png", "test,position=TL")
+
+        out = StringIO()
+        call_command("watermark_gc", stdout=out)
+        self.assertIn("Deleted 1 outdated images, 2 index entries.", out.getvalue())
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, old_url[len("/media/"):])))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, new_url[len("/media/"):])))
+        self.assertEqual(WatermarkedImage.objects.count(), 1)
+
+    def test_gc_missing(self):
+        url = watermark("/media/test.png", "test,position=BR")
+        os.remove(os.path.join(self.media_root, url[len("/media/"):]))
+
+        out = StringIO()
+        call_command("watermark_gc", "--missing", "--dry-run", stdout=out)
+        self.assertIn("1 images were missing.", out.getvalue())
+        self.assertEqual(WatermarkedImage.objects.count(), 1)
+
+        call_command("watermark_gc", "--missing", stdout=out)
+        self.assertEqual(WatermarkedImage.objects.count(), 0)
+        self.assertEqual(watermark("/media/test.png", "test,position=BR"), url)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, url[len("/media/"):])))
+
+    def test_max_size(self):
+        with Image.open(os.path.join(self.media_root, "test.png")) as im:
+            width, height = im.size
+
+        url = watermark("/media/test.png", "test,position=BR,max_size=%i" % (width // 2))
+        self.assertNotEqual(url, watermark("/media/test.png", "test,position=BR"))
+        with Image.open(os.path.join(self.media_root, url[len("/media/"):])) as im:
+            self.assertEqual(im.size[0], width // 2)
+
+    def test_batch(self):
+        for i in range(3):
+            shutil.copy(os.path.join(self.media_root, "test.png"), os.path.join(self.media_root, "%i.png" % i))
+        tmpl = Template(
+            "{% load watermark %}{% watermark_batch %}{% for url in urls %}"
+            "{{ url|watermark:'test,position=BR' }} {% cycle 'a' 'b' %} {% endfor %}{% endwatermark_batch %}"
+        )
+        context = Context({"urls": ["/media/%i.png" % i for i in range(3)]})
+        Watermarker().get_watermark("test")
+
+        with mock.patch.object(Watermarker, "render", autospec=True, side_effect=Watermarker.render) as mocked:
+            output = tmpl.render(context).split()
+        self.assertEqual(mocked.call_count, 3)
+        self.assertEqual(output[1::2], ["a", "b", "a"])
+        for url in output[::2]:
+            self.assertTrue(os.path.exists(os.path.join(self.media_root, url[len("/media/"):])))
+        self.assertEqual(WatermarkedImage.objects.count(), 3)
+
+        # all of them are found with a single query
+        cache.invalidate()
+        Watermarker().get_watermark("test")
+        with self.assertNumQueries(1):
+            self.assertEqual(tmpl.render(context).split(), output)
+
+    def test_format(self):
+        url = watermark("/media/test.png", "test,position=BR,format=webp")
+        self.assertTrue(url.endswith(".webp"))
+        with Image.open(os.path.join(self.media_root, url[len("/media/"):])) as im:
+            self.assertEqual(im.format, "WEBP")
+
+    @override_settings(WATERMARK_RANDOM_ROTATION_STEP=90)
+    def test_preload(self):
+        self.assertEqual(Watermarker().preload("test,rotation=R,opacity=50"), 4)
+        self.assertEqual(Watermarker().preload("test,scale=F"), 0)
+        with mock.patch("watermarker.utils.prepare_mark", side_effect=AssertionError):
+            for i in range(4):
+                watermark("/media/test.png", "test,position=BR,rotation=R,opacity=50")
+
+        cache.invalidate()
+        with override_settings(WATERMARK_PRELOAD=True), mock.patch("watermarker.apps._preloaded", False):
+            apps._preload()
+        self.assertEqual(len(cache.overlays), 1)
+
+    @override_settings(WATERMARK_CONTENT_HASH=True)
+    def test_content_hash(self):
+        os.makedirs(os.path.join(self.media_root, "copies"))
+        shutil.copy(os.path.join(TESTS_DIR, "test.png"), os.path.join(self.media_root, "copies", "copy.png"))
+
+        sources = ["/media/test.png", "/media/copies/copy.png"]
+        url = watermark("/media/test.png", "test,position=BR")
+        self.assertTrue(url.startswith("/media/watermarked/"))
+        self.assertEqual(watermark("/media/copies/copy.png", "test,position=BR"), url)
+
+        # a copy with a new modification time is still the same image
+        os.utime(os.path.join(self.media_root, "copies", "copy.png"), (0, 0))
+        with mock.patch.object(Watermarker, "create", side_effect=AssertionError):
+            self.assertEqual(watermark("/media/copies/copy.png", "test,position=BR"), url)
+            found = Watermarker().batch([(source, "test,position=BR") for source in sources])
+        self.assertEqual(set(found.values()), {url})
+        self.assertEqual(WatermarkedImage.objects.count(), 1)
+
+        # both are indexed under the same key
+        WatermarkedImage.objects.all().delete()
+        cache.invalidate()
+        found = Watermarker().batch([(source, "test,position=BR") for source in sources])
+        self.assertEqual(set(found.values()), {url})
+        self.assertEqual(WatermarkedImage.objects.count(), 1)
+
+    def test_animation(self):
+        frames = [Image.new("RGB", (120, 80), color) for color in ("red", "green", "blue")]
+        path = os.path.join(self.media_root, "animation.gif")
+        frames[0].save(path, save_all=True, append_images=frames[1:], duration=[50, 100, 150], loop=0)
+
+        url = watermark("/media/animation.gif", "test,position=BR")
+        with Image.open(os.path.join(self.media_root, url[len("/media/"):])) as im:
+            self.assertEqual((im.format, im.n_frames, im.info["loop"]), ("GIF", 3, 0))
+            durations = []
+            for i in range(im.n_frames):
+                im.seek(i)
+                durations.append(im.info["duration"])
+            self.assertEqual(durations, [50, 100, 150])
+
+        url = watermark("/media/animation.gif", "test,position=BR,format=webp")
+        with Image.open(os.path.join(self.media_root, url[len("/media/"):])) as im:
+            self.assertEqual((im.format, im.n_frames, im.info["loop"]), ("WEBP", 3, 0))
+
+        # animations that would take too much memory get the first frame
+        with override_settings(WATERMARK_ANIMATION_MAX_BYTES=1000):
+            url = watermark("/media/animation.gif", "test,position=BR,opacity=30")
+        with Image.open(os.path.join(self.media_root, url[len("/media/"):])) as im:
+            self.assertEqual(im.n_frames, 1)
+
+        # formats without animations get the first frame
+        url = watermark("/media/animation.gif", "test,position=BR,format=jpeg,max_size=60x40")
+        with Image.open(os.path.join(self.media_root, url[len("/media/"):])) as im:
+            self.assertEqual(im.size, (60, 40))
+
+    @override_settings(ROOT_URLCONF="watermarker.tests.urls")
+    def test_serve(self):
+        url = watermark_url("/media/test.png", "test,position=BR")
+        self.assertTrue(url.startswith("/watermarks/"))
+
+        response = self.client.get(url, HTTP_ACCEPT="image/webp,*/*")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(response["Vary"], "Accept")
+        with Image.open(BytesIO(b"".join(response.streaming_content))) as im:
+            self.assertEqual(im.format, "WEBP")
+
+        response = self.client.get(url, HTTP_ACCEPT="image/webp,*/*", HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+        with override_settings(WATERMARK_SENDFILE="X-Accel-Redirect"):
+            response = self.client.get(url)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertTrue(response["X-Accel-Redirect"].startswith("/media/watermarked/"))
+
+        self.assertEqual(self.client.get(url[:-2]).status_code, 404)
+        self.assertEqual(self.client.get(watermark_url("/media/test.png", "missing")).status_code, 404)
+
+        # editing the watermark gives the image a new URL, and the old one
+        # must not be cached anymore
+        self.mark.save()
+        self.assertNotEqual(watermark_url("/media/test.png", "test,position=BR"), url)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Cache-Control"], "no-cache")
+
+    def test_stats(self):
+        out = StringIO()
+        call_command("watermark_stats", "test,position=BR", "test.png", repeat=3, stdout=out)
+        output = out.getvalue()
+        for stage in ("call", "composite", "encode", "lookup"):
+            self.assertIn("\n%s " % stage, output)
+        self.assertIn("cache_hit: 2", output)
+        self.assertIn("rendered: 1", output)
+
+    @override_settings(WATERMARK_RENDER_EXECUTOR="watermarker.executors.ProcessExecutor", WATERMARK_RENDER_WORKERS=1)
+    def test_process_executor(self):
+        url = watermark("/media/test.png", "test,position=BR,opacity=50")
+        fpath = os.path.join(self.media_root, url[len("/media/"):])
+        with open(fpath, "rb") as f:
+            data = f.read()
+
+        # the same image is rendered in this process
+        os.remove(fpath)
+        WatermarkedImage.objects.all().delete()
+        get_manifest().clear()
+        cache.invalidate()
+        with override_settings(WATERMARK_RENDER_EXECUTOR="watermarker.executors.InlineExecutor"):
+            self.assertEqual(watermark("/media/test.png", "test,position=BR,opacity=50"), url)
+        with open(fpath, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    def test_render_error(self):
+        with mock.patch.object(InlineExecutor, "run", side_effect=RenderError("Too many images")):
+            self.assertEqual(watermark("/media/test.png", "test,position=BR"), "/media/test.png")
+            with override_settings(WATERMARK_BACKGROUND_PLACEHOLDER="/static/busy.png"):
+                self.assertEqual(watermark("/media/test.png", "test,position=BR"), "/static/busy.png")
+
+    @override_settings(ROOT_URLCONF="watermarker.tests.urls")
+    def test_serve_render_error(self):
+        url = watermark_url("/media/test.png", "test,position=BR")
+        with mock.patch.object(InlineExecutor, "run", side_effect=RenderError("Too many images")):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "5")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    @skipUnless(django.VERSION >= (3, 1), "async tests need Django 3.1")
+    @override_settings(WATERMARK_INDEX=False)
+    async def test_awatermark(self):
+        from asgiref.sync import sync_to_async
+
+        shutil.copy(os.path.join(self.media_root, "test.png"), os.path.join(self.media_root, "other.png"))
+        urls = await awatermark_many(["/media/test.png", "/media/other.png"], "test,position=BR", limit=1)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, urls[1][len("/media/"):])))
+
+        cache.invalidate()
+        self.assertEqual(await awatermark("/media/test.png", "test,position=BR"), urls[0])
+        self.assertEqual(await sync_to_async(watermark)("/media/other.png", "test,position=BR"), urls[1])
@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import os
+from unittest import mock
+from io import BytesIO
 
-from django.test import TestCase
-from PIL import Image
+from django.test import TestCase, override_settings
+from PIL import Image, ImageEnhance
 
-from ..utils import watermark
+from .. import cache
+from .. import utils
+from ..spec import WatermarkSpec
+from ..utils import determine_size, downscale, reduce_opacity, tile_mark, watermark, watermark_many
 
 
 class UtilsTestCase(TestCase):
@@ -14,19 +19,118 @@ class UtilsTestCase(TestCase):
         self.mark = Image.open(os.path.join(os.path.dirname(__file__), "overlay.png"))
 
     def test_tile(self):
-        watermark(self.im, self.mark, tile=True, opacity=0.5, rotation=30).save(
-            os.path.join(os.path.dirname(__file__), "test1.png")
-        )
+        watermark(self.im, self.mark, tile=True, opacity=0.5, rotation=30).save(BytesIO(), "PNG")
 
     def test_scale(self):
-        watermark(self.im, self.mark, scale="F").save(os.path.join(os.path.dirname(__file__), "test2.png"))
+        watermark(self.im, self.mark, scale="F").save(BytesIO(), "PNG")
 
     def test_grayscale(self):
         watermark(self.im, self.mark, position=(100, 100), opacity=0.5, greyscale=True, rotation=-45).save(
-            os.path.join(os.path.dirname(__file__), "test3.png")
+            BytesIO(), "PNG"
         )
 
     def test_position(self):
         watermark(self.im, self.mark, position="C", tile=False, opacity=0.2, scale=2, rotation=30).save(
-            os.path.join(os.path.dirname(__file__), "test4.png")
+            BytesIO(), "PNG"
         )
+
+    def test_overlay_cache(self):
+        cache.overlays.clear()
+        first = watermark(self.im, self.mark, position="BR", opacity=0.5, rotation=30, mark_key="test")
+        second = watermark(self.im, self.mark, position="BR", opacity=0.5, rotation=30, mark_key="test")
+        self.assertEqual((cache.overlays.hits, cache.overlays.misses), (1, 1))
+        self.assertEqual(first.tobytes(), second.tobytes())
+
+    def test_tile_mark(self):
+        mark = self.mark.convert("RGBA")
+        size, offset = (500, 333), (-7, -mark.size[1] + 3)
+
+        expected = Image.new("RGBA", size, (0, 0, 0, 0))
+        for y in range(offset[1], size[1], mark.size[1]):
+            for x in range(offset[0], size[0], mark.size[0]):
+                expected.paste(mark, (x, y))
+
+        self.assertEqual(tile_mark(mark, size, offset).tobytes(), expected.tobytes())
+
+    def test_region_composite(self):
+        im = self.im.convert("RGB")
+        mark = self.mark.convert("RGBA")
+        position = (im.size[0] - mark.size[0] // 2, 10)
+
+        layer = Image.new("RGBA", im.size, (0, 0, 0, 0))
+        layer.paste(mark, position)
+        expected = Image.composite(layer, im.convert("RGBA"), layer)
+
+        self.assertEqual(watermark(im, mark, position=position).tobytes(), expected.tobytes())
+        self.assertEqual(
+            watermark(im, mark, position=position, noalpha=True).tobytes(), expected.convert("RGB").tobytes()
+        )
+
+    def test_determine_size(self):
+        self.assertEqual(determine_size(None, (4000, 3000)), (4000, 3000))
+        self.assertEqual(determine_size("1200", (4000, 3000)), (1200, 900))
+        self.assertEqual(determine_size("1000x1000", (3000, 4000)), (750, 1000))
+        self.assertEqual(determine_size("5000", (4000, 3000)), (4000, 3000))
+        self.assertRaises(ValueError, determine_size, "big", (4000, 3000))
+
+    def test_downscale(self):
+        buf = BytesIO()
+        Image.effect_noise((2400, 1600), 64).convert("RGB").save(buf, "JPEG")
+        buf.seek(0)
+
+        im = downscale(Image.open(buf), (300, 200))
+        self.assertEqual(im.size, (300, 200))
+
+    def test_watermark_many(self):
+        path = os.path.join(os.path.dirname(__file__), "test.png")
+        sources = [path, self.im, open(path, "rb"), path]
+        self.addCleanup(sources[2].close)
+
+        expected = watermark(self.im, self.mark, position="BR", opacity=0.5, scale="R20%").tobytes()
+        with mock.patch.object(utils, "prepare_mark", wraps=utils.prepare_mark) as mocked:
+            results = list(watermark_many(sources, self.mark, prefetch=1, position="BR", opacity=0.5, scale="R20%"))
+
+        self.assertEqual([source for source, im in results], sources)
+        for source, im in results:
+            self.assertEqual(im.tobytes(), expected)
+        self.assertEqual(mocked.call_count, 1)
+
+    def test_reduce_opacity(self):
+        mark = self.mark.convert("RGBA")
+        for opacity in (0, 0.35, 0.5, 0.99, 1):
+            expected = mark.copy()
+            expected.putalpha(ImageEnhance.Brightness(mark.getchannel("A")).enhance(opacity))
+            self.assertEqual(reduce_opacity(mark, opacity).tobytes(), expected.tobytes())
+
+    def test_spec(self):
+        spec = WatermarkSpec.parse("test,position=C,opacity=50,scale=R50%,rotation=30")
+        expected = watermark(self.im, self.mark, position="C", opacity=0.5, scale="R50%", rotation=30)
+        self.assertEqual(watermark(self.im, self.mark, spec=spec).tobytes(), expected.tobytes())
+
+    def test_rotation(self):
+        mark = Image.new("RGBA", (100, 50), (255, 0, 0, 255))
+        rotated = utils.prepare_mark(mark, mark.size, rotation=90)
+        self.assertEqual(rotated.size, (50, 100))
+        self.assertEqual(rotated.getchannel("A").getextrema(), (255, 255))
+
+        # nothing is clipped off the corners
+        rotated = utils.prepare_mark(mark, mark.size, rotation=45)
+        self.assertAlmostEqual(rotated.getchannel("A").histogram()[255], 100 * 50, delta=100)
+
+    @override_settings(WATERMARK_RANDOM_ROTATION_STEP=90)
+    def test_random_rotation(self):
+        cache.overlays.clear()
+        for i in range(20):
+            watermark(self.im, self.mark, rotation="R", mark_key="test")
+        self.assertLessEqual(len(cache.overlays), 4)
+
+    def test_watermark_frames(self):
+        frames = [Image.new("RGB", (120, 80), color) for color in ("red", "green", "blue")]
+        buf = BytesIO()
+        frames[0].save(buf, "GIF", save_all=True, append_images=frames[1:], duration=[50, 100, 150], loop=0)
+
+        with Image.open(buf) as img:
+            watermarked = list(utils.watermark_frames(img, self.mark, position="C", size=(60, 40), workers=2))
+        self.assertEqual([frame.size for frame in watermarked], [(60, 40)] * 3)
+        self.assertEqual([frame.info["duration"] for frame in watermarked], [50, 100, 150])
+        self.assertEqual(watermarked[1].getpixel((0, 0))[:3], (0, 128, 0))
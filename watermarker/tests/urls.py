@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+from django.urls import include, path
+
+urlpatterns = [
+    path("watermarks/", include("watermarker.urls")),
+]
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+from django.urls import path
+
+from . import views
+
+app_name = "watermarker"
+
+urlpatterns = [
+    path("<str:token>", views.serve, name="serve"),
+]
@@ -5,13 +5,53 @@ Utilities for applying a watermark to an image using PIL.
 Stolen from http://code.activestate.com/recipes/362879/
 
 """
+import hashlib
+import os
 import re
 import random
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from importlib import import_module
 
-from PIL import Image, ImageEnhance
+from django.utils.functional import SimpleLazyObject
 
+from . import cache, metrics
 from .conf import settings
 
+# PIL takes a while to import and is not needed until an image is opened,
+# which processes that find all images in the caches and the index never do
+Image = SimpleLazyObject(lambda: import_module("PIL.Image"))
+ImageSequence = SimpleLazyObject(lambda: import_module("PIL.ImageSequence"))
+
+
+class Dimensions(object):
+    """Stands in for an image when only its size matters"""
+
+    def __init__(self, size):
+        self.size = size
+
+
+def fingerprint(path, fstat=None, chunk_size=1024 * 1024):
+    """
+    Returns a fingerprint of the contents of the file at `path`.  It is kept
+    for as long as the modification time and size of the file stay the same.
+    """
+    if fstat is None:
+        fstat = os.stat(path)
+    key = (path, fstat.st_mtime_ns, fstat.st_size)
+    value = cache.fingerprints.get(key)
+    if value is None:
+        with metrics.span("fingerprint"):
+            digest = hashlib.blake2b(digest_size=16)
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    digest.update(chunk)
+        value = digest.hexdigest()
+        cache.fingerprints.set(key, value)
+    return value
+
 
 def _percent(var):
     """
@@ -54,14 +94,51 @@ def reduce_opacity(img, opacity):
 
     if img.mode != "RGBA":
         img = img.convert("RGBA")
-    else:
-        img = img.copy()
 
-    alpha = img.split()[3]
-    alpha = ImageEnhance.Brightness(alpha).enhance(opacity)
-    img.putalpha(alpha)
+    # scale the alpha band with a lookup table and leave the others alone,
+    # which does in a single pass what ImageEnhance.Brightness would do to
+    # the alpha band
+    return img.point(_opacity_table(opacity))
+
+
+def _opacity_table(opacity):
+    """
+    Returns a lookup table for ``Image.point`` that scales the alpha band of
+    an RGBA image by `opacity`, rounding exactly like ``ImageEnhance`` does
+    (single-precision floats, truncated).
+    """
+    opacity = _float32(opacity)
+    return list(range(256)) * 3 + [int(_float32(opacity * value)) for value in range(256)]
 
-    return img
+
+def _float32(value):
+    return struct.unpack("f", struct.pack("f", value))[0]
+
+
+@lru_cache(maxsize=256)
+def _parse_scale(scale):
+    """
+    Parses a scale value once, returning ``("F", None)``, ``("R", percentage)``
+    or ``(None, factor)``.
+    """
+    try:
+        return None, float(scale)
+    except (ValueError, TypeError):
+        pass
+
+    if isinstance(scale, str) and scale.upper() == "F":
+        return "F", None
+
+    match = re.match(r"R(\d{1,3})\%", scale.upper()) if isinstance(scale, str) else None
+    if match:
+        return "R", float(match.group(1))
+
+    raise ValueError(
+        'Invalid scale value "%s"! Valid values are "F" '
+        'for ratio-preserving scaling, "R%%" for percantage aspect '
+        "ratio of source image and floating-point numbers and "
+        "integers greater than 0." % scale
+    )
 
 
 def determine_scale(scale, img, mark):
@@ -74,28 +151,19 @@ def determine_scale(scale, img, mark):
 
     """
     if scale:
-        try:
-            scale = float(scale)
-        except (ValueError, TypeError):
-            pass
+        kind, value = _parse_scale(scale)
 
-        if isinstance(scale, str) and scale.upper() == "F":
+        if kind == "F":
             # scale watermark to full, but preserve the aspect ratio
             scale = min(float(img.size[0]) / mark.size[0], float(img.size[1]) / mark.size[1])
-        elif isinstance(scale, str) and re.match(r"R\d{1,3}\%", scale.upper()):
+        elif kind == "R":
             # scale watermark to % of source image and preserve the aspect ratio
-            percentage = float(re.match(r"R(\d{1,3})\%", scale.upper()).group(1))
             scale = (
                 min(float(img.size[0]) / mark.size[0], float(img.size[1]) / mark.size[1])
-                / 100 * percentage
-            )
-        elif not isinstance(scale, (float, int)):
-            raise ValueError(
-                'Invalid scale value "%s"! Valid values are "F" '
-                'for ratio-preserving scaling, "R%%" for percantage aspect '
-                "ratio of source image and floating-point numbers and "
-                "integers greater than 0." % scale
+                / 100 * value
             )
+        else:
+            scale = value
 
         # determine the new width and height
         w = int(mark.size[0] * float(scale))
@@ -107,12 +175,56 @@ def determine_scale(scale, img, mark):
         return mark.size
 
 
+def determine_size(max_size, size):
+    """
+    Determines the size of an image of `size` scaled down to fit into
+    `max_size`, preserving the aspect ratio.  `max_size` is either a single
+    number that limits both the width and the height, or 'WxH'.  Images
+    are never enlarged.
+
+    """
+    if not max_size:
+        return size
+
+    try:
+        if isinstance(max_size, str):
+            if "x" in max_size.lower():
+                max_w, max_h = [_int(v) for v in max_size.lower().split("x")]
+            else:
+                max_w = max_h = _int(max_size)
+        elif isinstance(max_size, (tuple, list)):
+            max_w, max_h = [int(v) for v in max_size]
+        else:
+            max_w = max_h = int(max_size)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid max_size value "%s"! Valid values are "N" and "WxH".' % (max_size,))
+
+    ratio = min(float(max_w) / size[0], float(max_h) / size[1])
+    if ratio >= 1:
+        return size
+    return max(int(round(size[0] * ratio)), 1), max(int(round(size[1] * ratio)), 1)
+
+
+def downscale(img, size):
+    """
+    Scales `img` down to `size` as cheaply as possible.  JPEG images are
+    decoded at a reduced scale right away, and most of the remaining work is
+    done by fast integer reduction before the final resampling.
+    """
+    img.draft(None, size)
+    if img.size == size:
+        return img
+    return img.resize(size, resample=Image.LANCZOS, reducing_gap=2.0)
+
+
 def determine_rotation(rotation, mark):
     """
-    Determines the number of degrees to rotate the watermark image.
+    Determines the number of degrees to rotate the watermark image.  Random
+    rotations are multiples of ``WATERMARK_RANDOM_ROTATION_STEP`` degrees, so
+    there is a limited number of rotated watermarks to prepare and keep.
     """
     if isinstance(rotation, str) and rotation.lower() == "r":
-        rotation = random.randint(0, 359)
+        rotation = random.randrange(0, 360, settings.WATERMARK_RANDOM_ROTATION_STEP)
     else:
         rotation = _int(rotation)
 
@@ -147,44 +259,134 @@ def determine_position(position, img, mark):
     if isinstance(position, tuple):
         left, top = position
     elif isinstance(position, str):
-        position = position.lower()
+        kind, left, top = _parse_position(position)
 
         # corner positioning
-        if position in ["tl", "tr", "br", "bl"]:
-            if "t" in position:
-                top = 0
-            elif "b" in position:
-                top = max_top
-            if "l" in position:
-                left = 0
-            elif "r" in position:
-                left = max_left
+        if kind == "corner":
+            top = max_top if top else 0
+            left = max_left if left else 0
 
         # center positioning
-        elif position == "c":
+        elif kind == "c":
             left = int(max_left / 2)
             top = int(max_top / 2)
 
         # random positioning
-        elif position == "r":
+        elif kind == "r":
             left = random.randint(0, max_left)
             top = random.randint(0, max_top)
 
         # relative or absolute positioning
-        elif "x" in position:
-            left, top = position.split("x")
+        elif kind == "xy":
+            left = max_left * left[1] if left[0] else left[1]
+            top = max_top * top[1] if top[0] else top[1]
 
-            if "%" in left:
-                left = max_left * _percent(left)
-            else:
-                left = _int(left)
+    return int(left), int(top)
 
-            if "%" in top:
-                top = max_top * _percent(top)
-            else:
-                top = _int(top)
 
-    return int(left), int(top)
+@lru_cache(maxsize=256)
+def _parse_position(position):
+    """
+    Parses a position string once, returning its kind along with the left
+    and top values.  For corners, those tell whether the watermark goes to
+    the right and to the bottom.  For relative or absolute positions, they
+    are ``(is_percentage, value)`` tuples.
+    """
+    position = position.lower()
+
+    if position in ["tl", "tr", "br", "bl"]:
+        return "corner", "r" in position, "b" in position
+    elif position in ["c", "r"]:
+        return position, 0, 0
+    elif "x" in position:
+        left, top = position.split("x")
+
+        if "%" in left:
+            left = (True, _percent(left))
+        else:
+            left = (False, _int(left))
+
+        if "%" in top:
+            top = (True, _percent(top))
+        else:
+            top = (False, _int(top))
+
+        return "xy", left, top
+
+    return None, 0, 0
+
+
+def prepare_mark(mark, size, opacity=1, greyscale=False, rotation=0):
+    """
+    Returns a copy of `mark` scaled to `size`, with its opacity reduced,
+    converted to greyscale and rotated as requested.
+    """
+    if size[0] != mark.size[0] or size[1] != mark.size[1]:
+        mark = mark.resize(size, resample=Image.LANCZOS)
+
+    if opacity < 1:
+        mark = reduce_opacity(mark, opacity)
+
+    if greyscale and mark.mode != "LA":
+        mark = mark.convert("LA")
+
+    if rotation % 360 != 0:
+        if mark.mode not in ("RGBA", "LA"):
+            mark = mark.convert("RGBA")
+
+        # grow the image just enough to hold the rotated watermark, with
+        # transparent corners
+        mark = mark.rotate(rotation, expand=True)
+
+    return mark
+
+
+def _get_prepared_mark(mark, scale, opacity, greyscale, rotation, mark_key=None, overlays=None):
+    # the prepared mark only depends on the parameters below, so it can be
+    # shared between images if the caller tells us which watermark this is
+    if overlays is None:
+        overlays = cache.overlays
+    key = None
+    if mark_key is not None:
+        key = (mark_key, scale, opacity, greyscale, rotation % 360)
+
+    prepared = overlays.get(key) if key is not None else None
+    if prepared is None:
+        with metrics.span("prepare"):
+            prepared = prepare_mark(mark, scale, opacity, greyscale, rotation)
+        if key is not None:
+            overlays.set(key, prepared)
+    return prepared
+
+
+def tile_mark(mark, size, offset=(0, 0)):
+    """
+    Returns a transparent RGBA image of the specified size covered with
+    copies of `mark`, the first one having its top-left corner at `offset`.
+
+    Rather than pasting every single tile, one row of tiles is built by
+    repeatedly doubling the part of it that is already filled, and that row
+    is then pasted once per line of tiles.
+    """
+    mark_w, mark_h = mark.size
+    left, top = offset[0] % mark_w, offset[1] % mark_h
+    if left:
+        left -= mark_w
+    if top:
+        top -= mark_h
+
+    width = size[0] - left
+    row = Image.new("RGBA", (width, mark_h), (0, 0, 0, 0))
+    row.paste(mark, (0, 0))
+    filled = mark_w
+    while filled < width:
+        row.paste(row.crop((0, 0, filled, mark_h)), (filled, 0))
+        filled *= 2
+
+    layer = Image.new("RGBA", size, (0, 0, 0, 0))
+    for y in range(top, size[1], mark_h):
+        layer.paste(row, (left, y))
+    return layer
 
 
 def watermark(
@@ -197,57 +399,202 @@ def watermark(
     greyscale=False,
     rotation=0,
     return_name=False,
+    mark_key=None,
+    noalpha=False,
+    overlays=None,
+    spec=None,
     **kwargs
 ):
-    """Adds a watermark to an image"""
+    """
+    Adds a watermark to an image.  The result is an RGBA image, unless
+    `noalpha` is set and `img` is an RGB image, in which case the result is
+    an RGB image as well.
 
-    if opacity < 1:
-        mark = reduce_opacity(mark, opacity)
+    If `mark_key` identifies the watermark, the prepared watermark is kept
+    in `overlays` (an ``LRUCache``, the process-wide one by default) for
+    other images.
+
+    A ``WatermarkSpec`` given as `spec` takes the place of the options.
+    """
+    if spec is not None:
+        position, opacity, scale, tile = spec.position, spec.opacity, spec.scale, spec.tile
+        greyscale, rotation, noalpha = spec.greyscale, spec.rotation, spec.noalpha
 
     if not isinstance(scale, tuple):
         scale = determine_scale(scale, img, mark)
 
-    if scale[0] != mark.size[0] and scale[1] != mark.size[1]:
-        mark = mark.resize(scale, resample=Image.ANTIALIAS)
-
-    if greyscale and mark.mode != "LA":
-        mark = mark.convert("LA")
-
     rotation = determine_rotation(rotation, mark)
-    if rotation != 0:
-        # give some leeway for rotation overlapping
-        new_w = int(mark.size[0] * 1.5)
-        new_h = int(mark.size[1] * 1.5)
-
-        new_mark = Image.new("RGBA", (new_w, new_h), (0, 0, 0, 0))
-
-        # center the watermark in the newly resized image
-        new_l = int((new_w - mark.size[0]) / 2)
-        new_t = int((new_h - mark.size[1]) / 2)
-        new_mark.paste(mark, (new_l, new_t))
 
-        mark = new_mark.rotate(rotation)
+    mark = _get_prepared_mark(mark, scale, opacity, greyscale, rotation, mark_key, overlays)
 
     position = determine_position(position, img, mark)
 
-    if img.mode != "RGBA":
-        img = img.convert("RGBA")
-
     # make sure we have a tuple for a position now
     assert isinstance(position, tuple), 'Invalid position "%s"!' % position
 
-    # create a transparent layer the size of the image and draw the
-    # watermark in that layer.
-    layer = Image.new("RGBA", img.size, (0, 0, 0, 0))
     if tile:
+        # create a transparent layer the size of the image and draw the
+        # watermark in that layer.
         first_y = int(position[1] % mark.size[1] - mark.size[1])
         first_x = int(position[0] % mark.size[0] - mark.size[0])
 
-        for y in range(first_y, img.size[1], mark.size[1]):
-            for x in range(first_x, img.size[0], mark.size[0]):
-                layer.paste(mark, (x, y))
+        layer = tile_mark(mark, img.size, (first_x, first_y))
+
+        if noalpha and img.mode == "RGB":
+            # the alpha channel would be thrown away anyway, so there is no
+            # need to convert the image to RGBA and back
+            img = img.copy()
+            img.paste(layer, (0, 0), layer)
+            return img
+
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
+
+        # composite the watermark with the layer
+        return Image.composite(layer, img, layer)
+
+    # a single watermark only covers a small part of the image, so there is
+    # no need for a transparent layer the size of the whole image
+    if mark.mode != "RGBA":
+        mark = mark.convert("RGBA")
+    box = (position[0], position[1], position[0] + mark.size[0], position[1] + mark.size[1])
+
+    if noalpha and img.mode == "RGB":
+        # the alpha channel would be thrown away anyway, so there is no need
+        # to convert the image to RGBA
+        img = img.copy()
+    elif img.mode != "RGBA":
+        img = img.convert("RGBA")
     else:
-        layer.paste(mark, position)
+        img = img.copy()
+    img.paste(mark, box, mark)
+    return img
 
-    # composite the watermark with the layer
-    return Image.composite(layer, img, layer)
+
+def _load(source, max_size=None):
+    """Opens and decodes an image, scaling it down to `max_size` if given"""
+
+    img = source if isinstance(source, Image.Image) else Image.open(source)
+    if max_size:
+        size = determine_size(max_size, img.size)
+        if size != img.size:
+            return downscale(img, size)
+    img.load()
+    return img
+
+
+def watermark_many(images, mark, prefetch=2, workers=None, max_size=None, **kwargs):
+    """
+    Adds the same watermark with the same parameters to many images, which
+    may be given as paths, file objects or images.  Yields a
+    ``(source, watermarked image)`` tuple for each of them, in order.
+
+    The watermark is prepared only once for every size it has to be scaled
+    to.  While an image is being watermarked, the next `prefetch` images are
+    read and decoded by a pool of `workers` threads, so at most that many
+    decoded images are held in memory at a time.  If `max_size` is given,
+    images are scaled down to fit into it while they are decoded.
+
+    """
+    if not isinstance(mark, Image.Image):
+        mark = Image.open(mark)
+    mark.load()
+
+    overlays = cache.LRUCache(16)
+    images = iter(images)
+    pending = deque()
+
+    def fill():
+        while len(pending) <= prefetch:
+            try:
+                source = next(images)
+            except StopIteration:
+                return
+            pending.append((source, executor.submit(_load, source, max_size)))
+
+    executor = ThreadPoolExecutor(max_workers=workers or max(prefetch, 1), thread_name_prefix="watermarker")
+    try:
+        fill()
+        while pending:
+            source, future = pending.popleft()
+            img = future.result()
+            fill()
+            yield source, watermark(img, mark, mark_key="watermark_many", overlays=overlays, **kwargs)
+    finally:
+        for source, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def is_animated(img):
+    """Tells whether `img` has more than one frame"""
+
+    return getattr(img, "is_animated", False)
+
+
+def watermark_frames(
+    img,
+    mark,
+    position=(0, 0),
+    opacity=1,
+    scale=1.0,
+    tile=False,
+    greyscale=False,
+    rotation=0,
+    noalpha=False,
+    mark_key=None,
+    overlays=None,
+    spec=None,
+    size=None,
+    workers=None,
+    **kwargs
+):
+    """
+    Adds a watermark to every frame of an animated image, and yields the
+    watermarked frames in order, with their durations in ``info``.  Takes
+    the same parameters as ``watermark``, and `size` to scale the frames to.
+
+    The watermark is prepared and positioned once for all frames.  Frames
+    are decoded one after the other and watermarked on a pool of `workers`
+    threads, at most a few frames ahead of the caller, who decides which
+    frames to keep.
+    """
+    if spec is not None:
+        position, opacity, scale, tile = spec.position, spec.opacity, spec.scale, spec.tile
+        greyscale, rotation, noalpha = spec.greyscale, spec.rotation, spec.noalpha
+
+    if size is None:
+        size = img.size
+    canvas = Dimensions(size)
+
+    if not isinstance(scale, tuple):
+        scale = determine_scale(scale, canvas, mark)
+    rotation = determine_rotation(rotation, mark)
+    mark = _get_prepared_mark(mark, scale, opacity, greyscale, rotation, mark_key, overlays)
+    position = determine_position(position, canvas, mark)
+
+    def watermark_frame(frame, duration):
+        if frame.size != size:
+            frame = frame.resize(size, resample=Image.LANCZOS, reducing_gap=2.0)
+        # the watermark is ready to be pasted as is
+        frame = watermark(frame, mark, position=position, scale=mark.size, tile=tile, noalpha=noalpha, **kwargs)
+        if duration is not None:
+            frame.info["duration"] = duration
+        return frame
+
+    workers = workers or os.cpu_count() or 1
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="watermarker")
+    try:
+        for frame in ImageSequence.Iterator(img):
+            # frames have to be copied before seeking to the next one
+            copy = frame.convert("RGB" if noalpha else "RGBA")
+            pending.append(executor.submit(watermark_frame, copy, frame.info.get("duration")))
+            if len(pending) > 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import mimetypes
+import os
+from urllib.parse import quote, unquote
+
+from django.core import signing
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+
+from .conf import settings
+from .executors import RenderError
+from .formats import negotiate_format
+from .spec import WatermarkSpec
+from .storage import get_storage
+
+SALT = "watermarker.views.serve"
+
+# seconds that clients are asked to wait when an image can't be rendered
+# right now
+RETRY_AFTER = 5
+
+
+def get_version(url, name):
+    """
+    Identifies the current contents of a source image and the current
+    version of the watermark `name`, or returns ``None`` if either of them
+    does not exist
+    """
+    # the template tags import this module
+    from .templatetags.watermark import Watermarker
+
+    watermarker = Watermarker()
+    watermark = watermarker.get_watermark(name)
+    if watermark is None:
+        return None
+    try:
+        fstat = os.stat(watermarker._get_filesystem_path(url))
+    except OSError:
+        return None
+
+    key = watermarker.get_source_key(url, fstat) + (watermark.pk, watermark.date_updated.isoformat())
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+
+
+def get_token(url, args=""):
+    """
+    Signs the URL of a source image along with the arguments of the
+    ``watermark`` filter, which are validated right away, and the version
+    of both the image and the watermark, so the token changes with them
+    """
+    spec = WatermarkSpec.parse(args)
+    return signing.dumps([url, args, get_version(url, spec.name)], salt=SALT, compress=True)
+
+
+def get_serve_url(url, args=""):
+    """Returns the URL that ``serve`` renders a watermarked image at"""
+
+    return reverse("watermarker:serve", kwargs={"token": get_token(url, args)})
+
+
+@require_safe
+def serve(request, token):
+    """
+    Serves the watermarked image identified by a token of ``get_token``,
+    creating it first if necessary.  Unless the arguments ask for a format,
+    one is picked by the ``Accept`` header of the request.
+    """
+    # the template tags import this module
+    from .templatetags.watermark import Watermarker
+
+    try:
+        url, args, version = signing.loads(token, salt=SALT)
+    except (signing.BadSignature, ValueError):
+        raise Http404("Invalid token")
+
+    spec = WatermarkSpec.parse(args)._replace(background=False)
+    # a token of an image or watermark that has changed since stands for
+    # an image that does not exist anymore, so the current one can't be
+    # cached for good under its URL
+    current = version is not None and version == get_version(url, spec.name)
+    negotiate = spec.format is None
+    if negotiate:
+        spec = spec._replace(format=negotiate_format(request.META.get("HTTP_ACCEPT", "")))
+
+    watermarker = Watermarker()
+    watermarker.fallback_on_render_error = False
+    try:
+        url_path = watermarker(url, spec)
+    except FileNotFoundError:
+        raise Http404("Image does not exist")
+    except RenderError:
+        # the renderers are busy, unlike a missing image this is temporary
+        response = HttpResponse(status=503)
+        response["Retry-After"] = str(RETRY_AFTER)
+        response["Cache-Control"] = "no-cache"
+        return response
+    if url_path == url:
+        raise Http404("Watermark does not exist")
+
+    response = _serve(request, url_path)
+    if current and response.status_code != 302:
+        response["Cache-Control"] = settings.WATERMARK_SERVE_CACHE_CONTROL
+    else:
+        response["Cache-Control"] = "no-cache"
+    if negotiate:
+        patch_vary_headers(response, ("Accept",))
+    return response
+
+
+def _serve(request, url_path):
+    storage = get_storage()
+    base_url = getattr(storage, "base_url", None)
+    if not base_url or not url_path.startswith(base_url):
+        # the storage serves its files itself
+        return HttpResponseRedirect(url_path)
+
+    name = unquote(url_path[len(base_url):])
+    path = storage.path(name)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise Http404("Image does not exist")
+
+    etag = '"%s"' % hashlib.sha1(("%s:%i:%i" % (name, stat.st_mtime_ns, stat.st_size)).encode("utf-8")).hexdigest()
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        sendfile = settings.WATERMARK_SENDFILE
+        if sendfile is None:
+            response = FileResponse(open(path, "rb"), content_type=content_type)
+        else:
+            response = HttpResponse(content_type=content_type)
+            if sendfile.lower() == "x-accel-redirect":
+                prefix = settings.WATERMARK_SENDFILE_PREFIX or settings.MEDIA_URL
+                response[sendfile] = prefix + quote(name)
+            else:
+                prefix = settings.WATERMARK_SENDFILE_PREFIX
+                response[sendfile] = path if prefix is None else os.path.join(prefix, name)
+
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    return response